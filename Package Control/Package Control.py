@@ -7,6 +7,8 @@ import subprocess
 import zipfile
 import urllib
 import urllib2
+import httplib
+import socket
 import json
 import fnmatch
 import re
@@ -16,6 +18,16 @@ import time
 import shutil
 import _strptime
 import tempfile
+import hashlib
+import signal
+import zlib
+import struct
+import marshal
+import imp
+import filecmp
+import random
+import urlparse
+import email.utils
 
 try:
     import ssl
@@ -53,6 +65,9 @@ class ThreadProgress():
 
 
 class ChannelProvider():
+    # The number of deltas saved before the full channel is downloaded again
+    max_deltas = 20
+
     def __init__(self, channel, package_manager):
         self.channel_info = None
         self.channel = channel
@@ -65,20 +80,157 @@ class ChannelProvider():
         if self.channel_info != None:
             return
 
-        channel_json = self.package_manager.download_url(self.channel,
-            'Error downloading channel.')
+        # Channels that include a sync_token are asked only for what has
+        # changed since the last refresh. Only the token and the deltas
+        # received since the last full download are saved. They are applied
+        # on top of the full channel that download_url() already caches.
+        http_cache = DiskCache()
+        sync_key = self.channel + '.sync'
+        try:
+            synced = json.loads(http_cache.get(sync_key) or '{}')
+        except (ValueError):
+            synced = {}
+
+        # Mirrors only hold the full channel, so deltas aren't used with
+        # them or when creating one
+        use_delta = not self.package_manager.get_mirror_path() and \
+            self.package_manager.recorded_urls == None
+
+        channel_info = None
+        deltas = []
+        base = None
+        base_token = synced.get('base_token')
+        if use_delta and synced.get('sync_token'):
+            base = self.load_base(base_token)
+        if base:
+            separator = '?'
+            if self.channel.find('?') != -1:
+                separator = '&'
+            delta_url = self.channel + separator + urllib.urlencode(
+                {'since': synced['sync_token']})
+            channel_info = self.download_channel(delta_url, False)
+            if channel_info and channel_info.get('delta'):
+                if self.is_valid_delta(channel_info):
+                    # Deltas without any changes only move the token on
+                    deltas = synced.get('deltas', [])
+                    if [key for key, value in channel_info.items() if
+                            value and key not in ['delta', 'sync_token']]:
+                        deltas.append(channel_info)
+                    sync_token = channel_info['sync_token']
+                    channel_info = base
+                    for delta in deltas:
+                        channel_info = self.apply_delta(channel_info, delta)
+                    channel_info['sync_token'] = sync_token
+                else:
+                    print ('%s: The changes sent for channel %s were not ' +
+                        'valid, downloading the full channel') % (__name__,
+                        self.channel)
+                    channel_info = False
+
+        # A server that doesn't support deltas just returns the full channel
+        if not channel_info or channel_info.get('delta'):
+            channel_info = self.download_channel(self.channel, True)
+            deltas = []
+            if channel_info:
+                base_token = channel_info.get('sync_token')
+            # Servers that don't send validators have their full channel
+            # kept here instead, once per full download
+            if base_token and use_delta and not self.load_base(base_token):
+                try:
+                    http_cache.set(sync_key + '.base', json.dumps(
+                        channel_info))
+                except (OSError, IOError) as (e):
+                    print '%s: Error saving channel %s. %s' % (__name__,
+                        self.channel, str(e))
+
+        # If the channel stops including a sync_token, the saved state is
+        # dropped so that requests go back to the plain channel url. Once
+        # enough deltas pile up, the next refresh gets the full channel.
+        try:
+            if channel_info and channel_info.get('sync_token') and \
+                    len(deltas) < self.max_deltas:
+                http_cache.set(sync_key, json.dumps({
+                    'sync_token': channel_info['sync_token'],
+                    'base_token': base_token,
+                    'deltas': deltas
+                }))
+            elif channel_info and synced:
+                http_cache.set(sync_key, '{}')
+        except (OSError, IOError) as (e):
+            print '%s: Error saving channel %s. %s' % (__name__,
+                self.channel, str(e))
+
+        self.channel_info = channel_info
+
+    def load_base(self, base_token):
+        # Returns the cached full channel if it is the one the saved deltas
+        # apply to
+        http_cache = DiskCache()
+        for key in [self.channel.replace(' ', '%20'), self.channel +
+                '.sync.base']:
+            try:
+                base = json.loads(http_cache.get(key) or '{}')
+            except (ValueError):
+                continue
+            if base_token and base.get('sync_token') == base_token:
+                return base
+        return None
+
+    def download_channel(self, url, cache):
+        channel_json = self.package_manager.download_url(url,
+            'Error downloading channel.', cache=cache)
         if channel_json == False:
-            self.channel_info = False
-            return
+            return False
 
         try:
-            channel_info = json.loads(channel_json)
+            return json.loads(channel_json)
         except (ValueError):
             sublime.error_message(__name__ + ': Error parsing JSON from ' +
                 ' channel ' + self.channel + '.')
-            channel_info = False
+            return False
 
-        self.channel_info = channel_info
+    def is_valid_delta(self, delta):
+        if not isinstance(delta, dict) or not delta.get('sync_token'):
+            return False
+        if not isinstance(delta.get('removed_repositories', []), list):
+            return False
+        for key in ['removed_packages', 'packages']:
+            repos = delta.get(key, {})
+            if not isinstance(repos, dict):
+                return False
+            for entries in repos.values():
+                if not isinstance(entries, list):
+                    return False
+                if key == 'packages' and [entry for entry in entries if
+                        not isinstance(entry, dict) or 'name' not in entry]:
+                    return False
+        return True
+
+    def apply_delta(self, channel_info, delta):
+        # A delta contains the repositories, name map and renamed packages
+        # in full if they changed, and only the packages that were added,
+        # changed or removed
+        for key in ['repositories', 'package_name_map', 'renamed_packages']:
+            if key in delta:
+                channel_info[key] = delta[key]
+
+        packages = channel_info.setdefault('packages', {})
+        for repo in delta.get('removed_repositories', []):
+            if repo in packages:
+                del packages[repo]
+
+        for repo, names in delta.get('removed_packages', {}).items():
+            names = set(names)
+            packages[repo] = [package for package in packages.get(repo, [])
+                if package['name'] not in names]
+
+        for repo, changed in delta.get('packages', {}).items():
+            names = set([package['name'] for package in changed])
+            packages[repo] = [package for package in packages.get(repo, [])
+                if package['name'] not in names] + changed
+
+        channel_info['sync_token'] = delta['sync_token']
+        return channel_info
 
     def get_name_map(self):
         self.fetch_channel()
@@ -143,7 +295,7 @@ class PackageProvider():
             return
 
         repository_json = self.package_manager.download_url(self.repo,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if repository_json == False:
             self.repo_info = False
             return
@@ -212,7 +364,7 @@ class GitHubPackageProvider():
             'https://api.github.com/repos/\\1/\\2', self.repo)
 
         repo_json = self.package_manager.download_url(api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if repo_json == False:
             return False
 
@@ -227,7 +379,7 @@ class GitHubPackageProvider():
             urllib.urlencode({'sha': branch, 'per_page': 1})
 
         commit_json = self.package_manager.download_url(commit_api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if commit_json == False:
             return False
 
@@ -287,7 +439,7 @@ class GitHubUserProvider():
         api_url = 'https://api.github.com/users/%s/repos?per_page=100' % user
 
         repo_json = self.package_manager.download_url(api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if repo_json == False:
             return False
 
@@ -298,15 +450,32 @@ class GitHubUserProvider():
                 ' repository ' + api_url + '.')
             return False
 
-        packages = {}
+        # The commit info for each repository is fetched concurrently, with
+        # the downloaders pacing the requests to the API rate limit
+        settings = self.package_manager.settings
+        scheduler = JobScheduler(
+            settings.get('repository_download_domain_limit', 4))
         for package_info in repo_info:
             commit_api_url = ('https://api.github.com/repos/%s/%s/commits' + \
                 '?sha=master&per_page=1') % (user, package_info['name'])
 
-            commit_json = self.package_manager.download_url(commit_api_url,
-                'Error downloading repository.')
+            def download_commit(url=commit_api_url):
+                return self.package_manager.download_url(url,
+                    'Error downloading repository.', cache=True)
+            download_commit.url = commit_api_url
+            scheduler.add(download_commit)
+
+        commits = {}
+        for job, commit_json in scheduler.run():
             if commit_json == False:
                 return False
+            commits[job.url] = commit_json
+
+        packages = {}
+        for package_info in repo_info:
+            commit_api_url = ('https://api.github.com/repos/%s/%s/commits' + \
+                '?sha=master&per_page=1') % (user, package_info['name'])
+            commit_json = commits[commit_api_url]
 
             try:
                 commit_info = json.loads(commit_json)
@@ -361,7 +530,7 @@ class BitBucketPackageProvider():
             'https://api.bitbucket.org/1.0/repositories/', self.repo)
         api_url = api_url.rstrip('/')
         repo_json = self.package_manager.download_url(api_url,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if repo_json == False:
             return False
         try:
@@ -373,7 +542,7 @@ class BitBucketPackageProvider():
 
         changeset_url = api_url + '/changesets/default'
         changeset_json = self.package_manager.download_url(changeset_url,
-            'Error downloading repository.')
+            'Error downloading repository.', cache=True)
         if changeset_json == False:
             return False
         try:
@@ -419,6 +588,10 @@ class BinaryNotFoundError(Exception):
     pass
 
 
+class DownloadCancelledError(Exception):
+    pass
+
+
 class NonCleanExitError(Exception):
     def __init__(self, returncode):
         self.returncode = returncode
@@ -427,6 +600,349 @@ class NonCleanExitError(Exception):
         return repr(self.returncode)
 
 
+class StreamedDownload():
+    # Writes a download to a temp file next to its destination, hashing the
+    # content as it arrives so the whole file is never held in memory
+    chunk_size = 65536
+
+    def __init__(self, path):
+        self.path = path
+        tmp_fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.tmp')
+        self.file = os.fdopen(tmp_fd, 'wb')
+        self.hash = hashlib.sha256()
+        self.size = 0
+        # Set from another thread to stop the download at the next chunk
+        self.cancelled = False
+        self.first_byte_time = None
+        # The ETag or Last-Modified date of the response being written,
+        # which is needed to safely resume it after an interruption
+        self.validator = None
+        # Byte counts of earlier, interrupted attempts that were kept and
+        # that had to be thrown away
+        self.resumed = 0
+        self.discarded = 0
+
+    def write(self, chunk):
+        if self.cancelled:
+            raise DownloadCancelledError('The download was cancelled')
+        if self.first_byte_time == None:
+            self.first_byte_time = time.time()
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def reset(self):
+        # Called before each attempt so a retry doesn't append to the
+        # content from a failed attempt
+        self.discarded += self.size
+        self.file.seek(0)
+        self.file.truncate()
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def set_validator(self, headers):
+        # Only servers that accept ranges are asked to resume a download
+        if headers.get('accept-ranges') != 'bytes' and \
+                not headers.get('content-range'):
+            self.validator = None
+            return
+
+        # Weak ETags can't be used with If-Range
+        etag = headers.get('etag', '')
+        if etag and not etag.startswith('W/'):
+            self.validator = etag
+        else:
+            self.validator = headers.get('last-modified')
+
+    def get_resume_headers(self):
+        # Returns the headers to request the rest of an interrupted download,
+        # with If-Range making sure the server only sends the rest if the
+        # file has not changed in the meantime
+        if not self.size or not self.validator:
+            return {}
+        return {'Range': 'bytes=%d-' % self.size, 'If-Range': self.validator}
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def commit(self):
+        self.file.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.tmp_path, self.path)
+        # Bytes of failed attempts were downloaded too
+        _profiler.count('package bytes downloaded', self.size +
+            self.discarded)
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class ContentDecoder():
+    # Decodes a gzip or deflate response body a chunk at a time
+    def __init__(self, encoding):
+        self.encoding = (encoding or '').strip().lower()
+        self.decompressor = None
+        self.started = False
+        if self.encoding in ['gzip', 'x-gzip']:
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+
+    def decode(self, chunk):
+        if not self.decompressor or not chunk:
+            return chunk
+        try:
+            data = self.decompressor.decompress(chunk)
+        except (zlib.error):
+            # Some servers send raw deflate data without the zlib header
+            if self.encoding != 'deflate' or self.started:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decompressor.decompress(chunk)
+        self.started = True
+        return data
+
+    def flush(self):
+        if not self.decompressor:
+            return ''
+        return self.decompressor.flush()
+
+
+class TransferStats():
+    # Counts the bytes of JSON received over the network, and how many
+    # bytes they were once decompressed
+    def __init__(self):
+        self.wire = 0
+        self.decoded = 0
+        self.lock = threading.Lock()
+
+    def add(self, wire, decoded):
+        self.lock.acquire()
+        try:
+            self.wire += wire
+            self.decoded += decoded
+        finally:
+            self.lock.release()
+        _profiler.count('json bytes downloaded', wire)
+
+
+_transfer_stats = TransferStats()
+
+# Sent with requests for JSON. Package files are already compressed.
+_accept_encoding = 'gzip, deflate'
+
+
+class OperationReport():
+    # Times the phases of an operation, such as installing a package, as a
+    # tree of nested spans, and counts the bytes and files it touches
+    def __init__(self, operation, target, settings):
+        self.operation = operation
+        self.target = target
+        self.settings = settings
+        self.thread = threading.current_thread()
+        self.root = {'name': operation, 'start': time.time(), 'spans': []}
+        self.stack = [self.root]
+        self.counters = {}
+        self.lock = threading.Lock()
+        # The operation itself and any background work it started, such as
+        # pruning a backup, have to finish before the report is complete
+        self.pending = 1
+
+    def begin(self, name, phase=False):
+        span = {'name': name, 'start': time.time(), 'spans': [],
+            'phase': phase}
+        self.stack[-1]['spans'].append(span)
+        self.stack.append(span)
+        return span
+
+    def end(self, span):
+        # Ends the span along with any phases still open inside of it
+        while span in self.stack:
+            self.stack.pop()['end'] = time.time()
+
+    def phase(self, name):
+        # A phase runs until the next phase at the same level starts
+        if self.stack[-1].get('phase'):
+            self.end(self.stack[-1])
+        self.begin(name, True)
+
+    def count(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        finally:
+            self.lock.release()
+
+    def hold(self):
+        self.lock.acquire()
+        try:
+            self.pending += 1
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+            finished = self.pending == 0
+        finally:
+            self.lock.release()
+        if finished:
+            self.emit()
+
+    def get_tree(self, span):
+        return {
+            'name': span['name'],
+            'duration': round(span.get('end', time.time()) - span['start'], 4),
+            'spans': [self.get_tree(child) for child in span['spans']]
+        }
+
+    def format_tree(self, tree, depth=0):
+        lines = ['%s%s: %.3fs' % ('  ' * depth, tree['name'],
+            tree['duration'])]
+        for child in tree['spans']:
+            lines.extend(self.format_tree(child, depth + 1))
+        return lines
+
+    def emit(self):
+        tree = self.get_tree(self.root)
+        if self.settings.get('debug'):
+            lines = self.format_tree(tree)
+            lines[0] = '%s: %s %s took %.3fs' % (__name__, self.operation,
+                self.target, tree['duration'])
+            for name in sorted(self.counters.keys()):
+                lines.append('  %s: %s' % (name, self.counters[name]))
+            print '\n'.join(lines)
+
+        history_size = self.settings.get('performance_history', 0)
+        if history_size:
+            _profiler.save({
+                'operation': self.operation,
+                'target': self.target,
+                'time': datetime.datetime.fromtimestamp(
+                    self.root['start']).strftime('%Y-%m-%d %H:%M:%S'),
+                'duration': tree['duration'],
+                'spans': tree['spans'],
+                'counters': self.counters,
+                'hostname': socket.gethostname(),
+                'sublime_platform': self.settings.get('platform'),
+                'sublime_version': self.settings.get('version')
+            }, history_size)
+
+
+class ProfilerSpan():
+    # Context manager returned by Profiler.operation() and Profiler.span()
+    def __init__(self, profiler, name, target=None, settings=None):
+        self.profiler = profiler
+        self.name = name
+        self.target = target
+        self.settings = settings
+        self.report = None
+        self.span = None
+        self.previous = None
+
+    def __enter__(self):
+        report = self.profiler.get_report()
+        owned = report and report.thread == threading.current_thread()
+        if owned:
+            self.span = report.begin(self.name)
+            self.report = report
+        elif self.settings != None and (self.settings.get('debug') or
+                self.settings.get('performance_history', 0)):
+            # Operations started from a worker thread, such as the installs
+            # of a PackageTransaction, get a report of their own
+            self.previous = report
+            self.report = OperationReport(self.name, self.target,
+                self.settings)
+            self.profiler.attach(self.report)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.report:
+            return False
+        if self.span:
+            self.report.end(self.span)
+            return False
+        self.report.end(self.report.root)
+        self.profiler.attach(self.previous)
+        self.report.release()
+        return False
+
+
+class Profiler():
+    # Tracks the OperationReport, if any, for each thread. Everything is a
+    # no-op unless the debug or performance_history settings are on.
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def get_report(self):
+        return getattr(self.local, 'report', None)
+
+    def attach(self, report):
+        # Worker threads are attached to the report of the thread that
+        # started them so their counts are included
+        self.local.report = report
+
+    def operation(self, name, target, settings):
+        # Starts a report, or a span when one is already being recorded
+        return ProfilerSpan(self, name, target, settings)
+
+    def span(self, name):
+        return ProfilerSpan(self, name)
+
+    def phase(self, name):
+        report = self.get_report()
+        if report and report.thread == threading.current_thread():
+            report.phase(name)
+
+    def count(self, name, amount=1):
+        report = self.get_report()
+        if report:
+            report.count(name, amount)
+
+    def get_path(self):
+        return os.path.join(sublime.packages_path(), 'User',
+            __name__ + '.performance.json')
+
+    def save(self, entry, history_size):
+        # Keeps a rolling history of reports so timings can be compared
+        # across upgrades and machines
+        self.lock.acquire()
+        try:
+            path = self.get_path()
+            history = []
+            try:
+                with open(path, 'rb') as f:
+                    history = json.load(f)
+            except (IOError, ValueError):
+                pass
+            history.append(entry)
+            history = history[-history_size:]
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    json.dump(history, f, indent=1)
+                if os.name == 'nt' and os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp_path, path)
+            except (OSError, IOError) as (e):
+                print '%s: Error saving the performance history. %s' % (
+                    __name__, str(e))
+        finally:
+            self.lock.release()
+
+
+_profiler = Profiler()
+
+
 class CliDownloader():
     def __init__(self, settings):
         self.settings = settings
@@ -442,11 +958,29 @@ class CliDownloader():
         raise BinaryNotFoundError('The binary ' + name + ' could not be ' +
             'located')
 
-    def execute(self, args):
-        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    def execute(self, args, sink=None):
+        if sink == None:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.stdout.read()
+
+        else:
+            # When streaming, the body is written to the sink as it arrives
+            # and any error output is kept separate from it
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                while True:
+                    chunk = proc.stdout.read(StreamedDownload.chunk_size)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+            except (DownloadCancelledError):
+                proc.kill()
+                proc.wait()
+                raise
+            output = proc.stderr.read()
 
-        output = proc.stdout.read()
         returncode = proc.wait()
         if returncode != 0:
             error = NonCleanExitError(returncode)
@@ -454,14 +988,199 @@ class CliDownloader():
             raise error
         return output
 
+    def clean_tmp_file(self):
+        for path in [self.tmp_file, self.tmp_file + '.post']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write_post_file(self, data):
+        # Request bodies are passed to curl and wget through a file
+        path = self.tmp_file + '.post'
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def parse_headers(self, lines):
+        # Only the headers from the last response are kept since proxies
+        # and redirects can cause more than one set to be output
+        code = None
+        headers = {}
+        for line in lines:
+            line = line.strip()
+            match = re.match('^HTTP/[\d\.]+\s+(\d+)', line)
+            if match:
+                code = int(match.group(1))
+                headers = {}
+                continue
+            if code != None and line.find(':') != -1:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return code, headers
+
+
+class HttpConnectionPool():
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, create):
+        # Returns a tuple of the connection and if it was reused
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                return (connections.pop(), True)
+        finally:
+            self.lock.release()
+        return (create(), False)
+
+    def record_use(self, reused):
+        # Only requests that succeed are counted, so that stale connections
+        # that had to be replaced don't inflate the reuse numbers
+        self.lock.acquire()
+        try:
+            if reused:
+                self.reused += 1
+            else:
+                self.created += 1
+        finally:
+            self.lock.release()
+
+    def put(self, key, connection):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+
+_connection_pool = HttpConnectionPool()
+
+
+class PooledResponse():
+    # Stands in for a socket so that urllib2 can wrap the response in a file
+    # object, while handing the connection back to the pool once the
+    # response has been completely read
+    def __init__(self, response, connection, key):
+        self.response = response
+        self.connection = connection
+        self.key = key
+        self.released = False
+        # Responses such as 304s have no body, so they are complete already
+        if response.length == 0:
+            response.close()
+            self.release()
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.response.will_close:
+            self.connection.close()
+        else:
+            _connection_pool.put(self.key, self.connection)
+
+    def recv(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def close(self):
+        # A response that was only partially read leaves the connection in
+        # an unknown state, so it can't be reused
+        if not self.released:
+            self.released = True
+            self.connection.close()
+
+
+class KeepAliveHandler():
+    def do_keepalive_open(self, connection_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict([(k, v) for k, v in req.headers.items()
+            if k not in headers]))
+        headers['Connection'] = 'keep-alive'
+        headers = dict([(k.title(), v) for k, v in headers.items()])
+
+        tunnel_headers = {}
+        if tunnel_host and 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = \
+                headers['Proxy-Authorization']
+            del headers['Proxy-Authorization']
+
+        def create():
+            connection = connection_class(host, timeout=req.timeout)
+            if tunnel_host:
+                set_tunnel = getattr(connection, 'set_tunnel', None) or \
+                    getattr(connection, '_set_tunnel')
+                set_tunnel(tunnel_host, headers=tunnel_headers)
+            return connection
+
+        key = (connection_class.__name__, host, tunnel_host)
+        while True:
+            connection, reused = _connection_pool.get(key, create)
+            try:
+                connection.request(req.get_method(), req.get_selector(),
+                    req.get_data(), headers)
+                response = connection.getresponse()
+                _connection_pool.record_use(reused)
+                break
+            except (socket.timeout) as (e):
+                connection.close()
+                raise urllib2.URLError(e)
+            except (socket.error, httplib.HTTPException) as (e):
+                connection.close()
+                # The server may have closed an idle connection, in which
+                # case we try again with the next one
+                if reused:
+                    continue
+                raise urllib2.URLError(e)
+
+        fp = socket._fileobject(PooledResponse(response, connection, key),
+            close=True)
+        http_file = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        http_file.code = response.status
+        http_file.msg = response.reason
+        return http_file
+
+
+class KeepAliveHTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self.do_keepalive_open(httplib.HTTPConnection, req)
+
+
+if hasattr(urllib2, 'HTTPSHandler'):
+    class KeepAliveHTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+        def https_open(self, req):
+            return self.do_keepalive_open(httplib.HTTPSConnection, req)
+
+
+_openers = {}
+
 
 class UrlLib2Downloader():
     def __init__(self, settings):
         self.settings = settings
 
-    def download(self, url, error_message, timeout, tries):
+    def get_opener(self):
         http_proxy = self.settings.get('http_proxy')
         https_proxy = self.settings.get('https_proxy')
+        key = (http_proxy, https_proxy)
+        if key in _openers:
+            return _openers[key]
+
         if http_proxy or https_proxy:
             proxies = {}
             if http_proxy:
@@ -473,21 +1192,100 @@ class UrlLib2Downloader():
             proxy_handler = urllib2.ProxyHandler(proxies)
         else:
             proxy_handler = urllib2.ProxyHandler()
-        urllib2.install_opener(urllib2.build_opener(proxy_handler))
 
+        handlers = [proxy_handler, KeepAliveHTTPHandler()]
+        if hasattr(urllib2, 'HTTPSHandler'):
+            handlers.append(KeepAliveHTTPSHandler())
+
+        # Openers are shared between threads instead of being installed
+        # globally, which would affect other plugins
+        _openers[key] = urllib2.build_opener(*handlers)
+        return _openers[key]
+
+    def download(self, url, error_message, timeout, tries, headers=None,
+            sink=None, data=None):
+        self.response_code = None
+        self.response_headers = {}
+
+        opener = self.get_opener()
+        request_headers = {"User-Agent": "Sublime Package Control"}
+        if sink == None:
+            request_headers['Accept-Encoding'] = _accept_encoding
+        if headers:
+            request_headers.update(headers)
+
+        attempt = 0
         while tries > 0:
             tries -= 1
+            attempt += 1
+            if not _rate_limiter.acquire(url, self.settings):
+                print '%s: %s Downloading %s is %s.' % (__name__,
+                    error_message, url, _rate_limiter.get_block_message(url))
+                return False
+
+            resume_headers = {}
+            if sink != None:
+                resume_headers = sink.get_resume_headers()
+            attempt_headers = request_headers.copy()
+            attempt_headers.update(resume_headers)
+
             try:
-                request = urllib2.Request(url, headers={"User-Agent":
-                    "Sublime Package Control"})
-                http_file = urllib2.urlopen(request, timeout=timeout)
-                return http_file.read()
+                request = urllib2.Request(url, data=data,
+                    headers=attempt_headers)
+                http_file = opener.open(request, timeout=timeout)
+                self.response_code = http_file.getcode()
+                self.response_headers = dict(http_file.info().items())
+                _rate_limiter.update(url, self.response_headers)
+                if sink == None:
+                    return self.read_body(http_file)
+
+                # A 206 means the server is sending the rest of the file
+                if resume_headers and self.response_code == 206:
+                    sink.resumed += sink.size
+                    length = self.response_headers.get('content-range',
+                        '').split('/')[-1]
+                else:
+                    sink.reset()
+                    length = self.response_headers.get('content-length')
+                sink.set_validator(self.response_headers)
+
+                # A response that isn't completely read, such as when a
+                # hedged download is cancelled, has its connection closed
+                # rather than left open
+                interrupted = False
+                try:
+                    try:
+                        while True:
+                            chunk = http_file.read(
+                                StreamedDownload.chunk_size)
+                            if not chunk:
+                                break
+                            sink.write(chunk)
+                    except (socket.error, httplib.HTTPException):
+                        interrupted = True
+                finally:
+                    http_file.close()
+
+                # Whatever was received is kept so the next attempt can
+                # resume from where this one was cut off
+                if length and length.isdigit() and sink.size < int(length):
+                    interrupted = True
+                if interrupted:
+                    print (__name__ + ': Downloading %s was interrupted ' +
+                        'after %s bytes, trying again') % (url, sink.size)
+                    continue
+                return True
 
             except (urllib2.HTTPError) as (e):
+                # urllib2 treats a 304 as an error, but it just means that
+                # the cached copy of the URL is still valid
+                if str(e.code) == '304':
+                    self.response_code = 304
+                    self.response_headers = dict(e.info().items())
+                    return ''
                 # Bitbucket and Github ratelimit using 503 a decent amount
-                if str(e.code) == '503':
-                    print (__name__ + ': Downloading %s was rate limited, ' +
-                        'trying again') % url
+                if tries > 0 and _rate_limiter.wait_to_retry(url, e.code,
+                        dict(e.info().items()), attempt, self.settings):
                     continue
                 print '%s: %s HTTP error %s downloading %s.' % (__name__,
                     error_message, str(e.code), url)
@@ -500,25 +1298,69 @@ class UrlLib2Downloader():
                     continue
                 print '%s: %s URL error %s downloading %s.' % (__name__,
                     error_message, str(e.reason), url)
+            except (socket.timeout):
+                # Once the response has started, a timeout comes from the
+                # socket rather than urllib2
+                print (__name__ + ': Downloading %s timed out, trying ' +
+                    'again') % url
+                continue
+            except (zlib.error) as (e):
+                print '%s: %s Error decompressing %s. %s' % (__name__,
+                    error_message, url, str(e))
             break
         return False
 
+    def read_body(self, http_file):
+        # The body is decompressed as it is read
+        decoder = ContentDecoder(self.response_headers.get('content-encoding'))
+        wire = 0
+        output = []
+        try:
+            while True:
+                chunk = http_file.read(StreamedDownload.chunk_size)
+                if not chunk:
+                    break
+                wire += len(chunk)
+                output.append(decoder.decode(chunk))
+            output.append(decoder.flush())
+        finally:
+            http_file.close()
+        output = ''.join(output)
+        _transfer_stats.add(wire, len(output))
+        return output
+
 
 class WgetDownloader(CliDownloader):
     def __init__(self, settings):
         self.settings = settings
         self.wget = self.find_binary('wget')
 
-    def clean_tmp_file(self):
-        os.remove(self.tmp_file)
+    def read_response_headers(self):
+        # The -S flag causes the server response to be indented in the log
+        with open(self.tmp_file) as f:
+            lines = [line for line in f if line.startswith('  ')]
+        self.response_code, self.response_headers = self.parse_headers(lines)
+
+    def download(self, url, error_message, timeout, tries, headers=None,
+            sink=None, data=None):
+        self.response_code = None
+        self.response_headers = {}
 
-    def download(self, url, error_message, timeout, tries):
         if not self.wget:
             return False
 
         self.tmp_file = tempfile.NamedTemporaryFile().name
         command = [self.wget, '--connect-timeout=' + str(int(timeout)), '-o',
-            self.tmp_file, '-O', '-', '-U', 'Sublime Package Control', url]
+            self.tmp_file, '-O', '-', '-U', 'Sublime Package Control', '-S']
+        if headers:
+            for name, value in headers.items():
+                command.append('--header=%s: %s' % (name, value))
+        # wget can't decompress responses itself, so that is done here
+        if sink == None:
+            command.append('--header=Accept-Encoding: ' + _accept_encoding)
+        if data != None:
+            command.append('--post-file=' + self.write_post_file(data))
+        command.append(url)
 
         if self.settings.get('http_proxy'):
             os.putenv('http_proxy', self.settings.get('http_proxy'))
@@ -527,13 +1369,39 @@ class WgetDownloader(CliDownloader):
         if self.settings.get('https_proxy'):
             os.putenv('https_proxy', self.settings.get('https_proxy'))
 
+        attempt = 0
         while tries > 1:
             tries -= 1
+            attempt += 1
+            if not _rate_limiter.acquire(url, self.settings):
+                print '%s: %s Downloading %s is %s.' % (__name__,
+                    error_message, url, _rate_limiter.get_block_message(url))
+                return False
             try:
-                result = self.execute(command)
+                if sink != None:
+                    sink.reset()
+                result = self.execute(command, sink)
+                self.read_response_headers()
+                _rate_limiter.update(url, self.response_headers)
                 self.clean_tmp_file()
-                return result
+                if sink != None:
+                    return True
+                decoder = ContentDecoder(self.response_headers.get(
+                    'content-encoding'))
+                try:
+                    decoded = decoder.decode(result) + decoder.flush()
+                except (zlib.error) as (e):
+                    print '%s: %s Error decompressing %s. %s' % (__name__,
+                        error_message, url, str(e))
+                    return False
+                _transfer_stats.add(len(result), len(decoded))
+                return decoded
             except (NonCleanExitError) as (e):
+                self.read_response_headers()
+                if self.response_code == 304:
+                    self.clean_tmp_file()
+                    return ''
+
                 error_line = ''
                 with open(self.tmp_file) as f:
                     for line in list(f):
@@ -542,11 +1410,10 @@ class WgetDownloader(CliDownloader):
                             break
 
                 if e.returncode == 8:
-                    regex = re.compile('^.*ERROR (\d+):.*', re.S)
-                    if re.sub(regex, '\\1', error_line) == '503':
-                        # GitHub and BitBucket seem to rate limit via 503
-                        print (__name__ + ': Downloading %s was rate limited' +
-                            ', trying again') % url
+                    # GitHub and BitBucket seem to rate limit via 503
+                    if tries > 1 and _rate_limiter.wait_to_retry(url,
+                            self.response_code, self.response_headers,
+                            attempt, self.settings):
                         continue
                     error_string = 'HTTP error ' + re.sub('^.*? ERROR ', '',
                         error_line)
@@ -572,15 +1439,37 @@ class WgetDownloader(CliDownloader):
 
 
 class CurlDownloader(CliDownloader):
+    # The output of curl --version, once it has been checked
+    version = None
+
     def __init__(self, settings):
         self.settings = settings
         self.curl = self.find_binary('curl')
 
-    def download(self, url, error_message, timeout, tries):
+    def read_response_headers(self):
+        with open(self.tmp_file) as f:
+            self.response_code, self.response_headers = \
+                self.parse_headers(list(f))
+
+    def download(self, url, error_message, timeout, tries, headers=None,
+            sink=None, data=None):
+        self.response_code = None
+        self.response_headers = {}
+
         if not self.curl:
             return False
+
+        self.tmp_file = tempfile.NamedTemporaryFile().name
         command = [self.curl, '-f', '--user-agent', 'Sublime Package Control',
-            '--connect-timeout', str(int(timeout)), '-sS', url]
+            '--connect-timeout', str(int(timeout)), '-sS', '-D', self.tmp_file]
+        if headers:
+            for name, value in headers.items():
+                command.extend(['-H', '%s: %s' % (name, value)])
+        if sink == None and self.supports_compression():
+            command.append('--compressed')
+        if data != None:
+            command.extend(['--data-binary', '@' + self.write_post_file(data)])
+        command.append(url)
 
         if self.settings.get('http_proxy'):
             os.putenv('http_proxy', self.settings.get('http_proxy'))
@@ -589,17 +1478,71 @@ class CurlDownloader(CliDownloader):
         if self.settings.get('https_proxy'):
             os.putenv('HTTPS_PROXY', self.settings.get('https_proxy'))
 
+        attempt = 0
         while tries > 1:
             tries -= 1
+            attempt += 1
+            if not _rate_limiter.acquire(url, self.settings):
+                print '%s: %s Downloading %s is %s.' % (__name__,
+                    error_message, url, _rate_limiter.get_block_message(url))
+                return False
+
+            # Interrupted downloads are resumed with -C. If the file has
+            # changed, If-Range makes the server send all of it, which
+            # curl refuses with exit code 33 and we start over.
+            attempt_command = command
+            resume_headers = {}
+            if sink != None:
+                resume_headers = sink.get_resume_headers()
+            if resume_headers:
+                attempt_command = command[:-1] + ['-C', str(sink.size),
+                    '-H', 'If-Range: ' + resume_headers['If-Range'],
+                    command[-1]]
+            resumed = sink != None and sink.size
+            self.response_code = None
+
             try:
-                return self.execute(command)
+                if sink != None and not resume_headers:
+                    sink.reset()
+                result = self.execute(attempt_command, sink)
+                self.read_response_headers()
+                _rate_limiter.update(url, self.response_headers)
+                self.clean_tmp_file()
+                if sink != None:
+                    if resume_headers:
+                        sink.resumed += resumed
+                    return True
+                # curl has already decompressed the body, so the size on the
+                # wire comes from the Content-Length, when there is one
+                wire = len(result)
+                length = self.response_headers.get('content-length', '')
+                if self.response_headers.get('content-encoding') and \
+                        length.isdigit():
+                    wire = int(length)
+                _transfer_stats.add(wire, len(result))
+                return result
             except (NonCleanExitError) as (e):
+                if sink != None and os.path.exists(self.tmp_file):
+                    self.read_response_headers()
+                    if self.response_code in [200, 206]:
+                        sink.set_validator(self.response_headers)
+                if resume_headers and self.response_code == 206:
+                    sink.resumed += resumed
+                if e.returncode in [18, 56] and sink != None:
+                    print (__name__ + ': Downloading %s was interrupted ' +
+                        'after %s bytes, trying again') % (url, sink.size)
+                    continue
+                if e.returncode == 33 and sink != None:
+                    sink.reset()
+                    sink.validator = None
+                    continue
                 if e.returncode == 22:
                     code = re.sub('^.*?(\d+)\s*$', '\\1', e.output)
-                    if code == '503':
-                        # GitHub and BitBucket seem to rate limit via 503
-                        print (__name__ + ': Downloading %s was rate limited' +
-                            ', trying again') % url
+                    if os.path.exists(self.tmp_file):
+                        self.read_response_headers()
+                    # GitHub and BitBucket seem to rate limit via 503
+                    if tries > 1 and _rate_limiter.wait_to_retry(url, code,
+                            self.response_headers, attempt, self.settings):
                         continue
                     error_string = 'HTTP error ' + code
                 elif e.returncode == 6:
@@ -615,16 +1558,860 @@ class CurlDownloader(CliDownloader):
                 print '%s: %s %s downloading %s.' % (__name__, error_message,
                     error_string, url)
             break
+        self.clean_tmp_file()
         return False
 
-_channel_repository_cache = {}
+    def get_version(self):
+        if CurlDownloader.version == None:
+            try:
+                CurlDownloader.version = self.execute([self.curl, '--version'])
+            except (NonCleanExitError):
+                CurlDownloader.version = ''
+        return CurlDownloader.version
+
+    def supports_parallel(self):
+        # --parallel was added in curl 7.66.0
+        match = re.match('curl (\\d+)\\.(\\d+)', self.get_version())
+        return match != None and \
+            (int(match.group(1)), int(match.group(2))) >= (7, 66)
+
+    def supports_compression(self):
+        # --compressed only works if curl was built with zlib
+        return re.search('^Features:.*\\blibz\\b', self.get_version(),
+            re.M) != None
+
+    def download_many(self, urls, timeout, workers=1, headers=None):
+        # Downloads all of the urls with a single curl process, returning a
+        # dict of url: (response code, content, response headers) for the
+        # ones that succeeded or were not modified. Failed urls are left out
+        # so they can be retried one at a time. headers is an optional dict
+        # of url: request headers, such as cache validators.
+        if not self.curl:
+            return {}
+        if headers == None:
+            headers = {}
+
+        tmp_dir = tempfile.mkdtemp()
+        config_path = os.path.join(tmp_dir, 'config')
+        output_paths = []
+
+        # The urls are passed in a config file since a command line with
+        # hundreds of urls would be too long on Windows. Each url is its own
+        # operation so that it can have its own headers and header file.
+        def quote(value):
+            return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        with open(config_path, 'w') as f:
+            for i in range(len(urls)):
+                output_paths.append(os.path.join(tmp_dir, str(i)))
+                if i > 0:
+                    f.write('next\n')
+                f.write('url = %s\n' % quote(urls[i]))
+                f.write('output = %s\n' % quote(output_paths[-1]))
+                f.write('dump-header = %s\n' % quote(output_paths[-1] +
+                    '.headers'))
+                f.write('user-agent = "Sublime Package Control"\n')
+                f.write('connect-timeout = %s\n' % int(timeout))
+                f.write('silent\nshow-error\n')
+                f.write('write-out = "PACKAGE_CONTROL_STATUS %{http_code} ' +
+                    '%{size_download} %{filename_effective}\\n"\n')
+                if self.supports_compression():
+                    f.write('compressed\n')
+                for name, value in headers.get(urls[i], {}).items():
+                    f.write('header = %s\n' % quote('%s: %s' % (name,
+                        value)))
+
+        command = [self.curl, '-sS', '-K', config_path]
+        if workers > 1 and self.supports_parallel():
+            command.extend(['--parallel', '--parallel-max', str(workers)])
+
+        if self.settings.get('http_proxy'):
+            os.putenv('http_proxy', self.settings.get('http_proxy'))
+            if not self.settings.get('https_proxy'):
+                os.putenv('HTTPS_PROXY', self.settings.get('http_proxy'))
+        if self.settings.get('https_proxy'):
+            os.putenv('HTTPS_PROXY', self.settings.get('https_proxy'))
+
+        try:
+            try:
+                output = self.execute(command)
+            except (NonCleanExitError) as (e):
+                # curl exits with the error of the last failed transfer, but
+                # still reports the status of every url
+                output = e.output
+
+            # The statuses are written as each transfer finishes, with any
+            # error messages mixed in between them
+            statuses = dict([(path, (code, size)) for code, size, path in
+                re.findall('^PACKAGE_CONTROL_STATUS (\\d+) (\\d+) (.*)$',
+                output, re.M)])
+            results = {}
+            for i in range(len(urls)):
+                code, size = statuses.get(output_paths[i], (None, 0))
+                if code not in ['200', '304']:
+                    continue
+                response_headers = {}
+                if os.path.exists(output_paths[i] + '.headers'):
+                    with open(output_paths[i] + '.headers') as f:
+                        response_headers = self.parse_headers(list(f))[1]
+                if code == '304':
+                    results[urls[i]] = (304, '', response_headers)
+                    continue
+                if not os.path.exists(output_paths[i]):
+                    continue
+                with open(output_paths[i], 'rb') as f:
+                    content = f.read()
+                results[urls[i]] = (200, content, response_headers)
+                _transfer_stats.add(int(size), len(content))
+            return results
+        finally:
+            shutil.rmtree(tmp_dir, True)
+
+
+class MirrorDownloader():
+    # Reads urls from a folder created by the Create Mirror command instead
+    # of going to the network
+    def __init__(self, settings, path):
+        self.settings = settings
+        self.path = path
+
+    def get_path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.path, 'urls', hashlib.sha1(url).hexdigest())
+
+    def download(self, url, error_message, timeout, tries, headers=None,
+            sink=None, data=None):
+        self.response_code = None
+        self.response_headers = {}
+
+        path = self.get_path(url)
+        if data != None or not os.path.exists(path):
+            print '%s: %s %s is not in the mirror at %s.' % (__name__,
+                error_message, url, self.path)
+            return False
+
+        self.response_code = 200
+        with open(path, 'rb') as f:
+            if sink == None:
+                return f.read()
+            sink.reset()
+            while True:
+                chunk = f.read(StreamedDownload.chunk_size)
+                if not chunk:
+                    break
+                sink.write(chunk)
+        return True
+
+
+class ExpiringCache():
+    # A thread-safe cache whose entries expire after a number of seconds,
+    # with the least recently used entries evicted once max_entries is
+    # reached
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # key: [expiration time, value, last use]
+        self.entries = {}
+        # key: a dict that will hold the result of the fetch in progress
+        self.in_flight = {}
+        self.uses = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.condition = threading.Condition()
+
+    def get(self, key):
+        # Returns None if there is no fresh entry for key
+        self.condition.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.uses += 1
+            entry[2] = self.uses
+            return entry[1]
+        finally:
+            self.condition.release()
+
+    def set(self, key, value, ttl):
+        self.condition.acquire()
+        try:
+            if key not in self.entries and \
+                    len(self.entries) >= self.max_entries:
+                self.evict()
+            self.uses += 1
+            self.entries[key] = [time.time() + ttl, value, self.uses]
+        finally:
+            self.condition.release()
+
+    def evict(self):
+        # Must be called with self.condition held
+        now = time.time()
+        for key in self.entries.keys():
+            if self.entries[key][0] <= now:
+                del self.entries[key]
+        if len(self.entries) >= self.max_entries:
+            oldest = min(self.entries.keys(),
+                key=lambda key: self.entries[key][2])
+            del self.entries[oldest]
+
+    def clear(self):
+        self.condition.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.condition.release()
+
+    def fetch(self, key, fetcher):
+        # Calls fetcher, which is expected to set key, and returns its
+        # result. If another thread is already fetching key, this waits for
+        # it to finish and returns the same result. The result is handed
+        # over directly, since it may not have been cached, such as when
+        # cache_length is 0.
+        self.condition.acquire()
+        try:
+            flight = self.in_flight.get(key)
+            if flight != None:
+                self.coalesced += 1
+                while self.in_flight.get(key) is flight:
+                    self.condition.wait()
+                return flight['result']
+            flight = {'result': False}
+            self.in_flight[key] = flight
+        finally:
+            self.condition.release()
+
+        try:
+            flight['result'] = fetcher()
+            return flight['result']
+        finally:
+            self.condition.acquire()
+            try:
+                del self.in_flight[key]
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+
+
+_channel_repository_cache = ExpiringCache(5000)
+
+
+class RateLimiter():
+    # Paces requests to API hosts with a token bucket per host, and makes
+    # every thread back off from a host once it reports that it is rate
+    # limiting us
+    def __init__(self):
+        self.lock = threading.Lock()
+        # host: (tokens, time of last refill)
+        self.buckets = {}
+        self.blocked_until = {}
+
+    def get_host(self, url):
+        return urlparse.urlparse(url)[1].lower()
+
+    def acquire(self, url, settings):
+        # Blocks until a request to the host of url may be made. Returns
+        # False, without waiting, if the host has blocked us for longer than
+        # the rate_limit_max_wait setting.
+        host = self.get_host(url)
+        max_wait = settings.get('rate_limit_max_wait', 60)
+        rate = settings.get('rate_limit_requests_per_second', 10)
+        burst = max(1, settings.get('rate_limit_burst', 20))
+        paced = rate and host in settings.get('rate_limited_hosts', [])
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                wait = self.blocked_until.get(host, 0) - now
+                if wait > max_wait:
+                    return False
+                if wait <= 0:
+                    if not paced:
+                        return True
+                    tokens, last = self.buckets.get(host, (burst, now))
+                    tokens = min(burst, tokens + (now - last) * rate)
+                    if tokens >= 1:
+                        self.buckets[host] = (tokens - 1, now)
+                        return True
+                    self.buckets[host] = (tokens, now)
+                    wait = (1 - tokens) / rate
+            finally:
+                self.lock.release()
+            time.sleep(wait)
+
+    def get_block_message(self, url):
+        until = self.blocked_until.get(self.get_host(url), 0)
+        return 'rate limited until %s' % datetime.datetime.fromtimestamp(
+            until).strftime('%Y-%m-%d %H:%M:%S')
+
+    def block(self, host, seconds):
+        self.lock.acquire()
+        try:
+            until = time.time() + seconds
+            if until > self.blocked_until.get(host, 0):
+                self.blocked_until[host] = until
+        finally:
+            self.lock.release()
+
+    def get_retry_after(self, headers):
+        # Retry-After may be a number of seconds or an HTTP date
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
+        date = email.utils.parsedate_tz(value)
+        if not date:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+    def update(self, url, headers):
+        # Uses the budget reported by the server so that we slow down before
+        # requests start failing
+        host = self.get_host(url)
+        remaining = headers.get('x-ratelimit-remaining', '')
+        if remaining.isdigit():
+            self.lock.acquire()
+            try:
+                if host in self.buckets:
+                    tokens, last = self.buckets[host]
+                    self.buckets[host] = (min(tokens, int(remaining)), last)
+            finally:
+                self.lock.release()
+            reset = headers.get('x-ratelimit-reset', '')
+            if int(remaining) == 0 and reset.isdigit():
+                self.block(host, int(reset) - time.time())
+
+        retry_after = self.get_retry_after(headers)
+        if retry_after != None:
+            self.block(host, retry_after)
+
+    def is_rate_limited(self, code, headers):
+        if code in [429, 503]:
+            return True
+        # GitHub uses a 403 once the hourly API limit is used up
+        return code == 403 and headers.get('x-ratelimit-remaining') == '0'
+
+    def wait_to_retry(self, url, code, headers, attempt, settings):
+        # Returns True, once it is time to try again, if the response was a
+        # rate limiting response that is worth waiting out
+        try:
+            code = int(code)
+        except (TypeError, ValueError):
+            return False
+        if not self.is_rate_limited(code, headers):
+            return False
+
+        host = self.get_host(url)
+        self.update(url, headers)
+        delay = self.blocked_until.get(host, 0) - time.time()
+        if delay <= 0:
+            # Without any hint from the server, back off exponentially with
+            # jitter so that threads don't all retry at the same moment
+            delay = min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+            self.block(host, delay)
+
+        max_wait = settings.get('rate_limit_max_wait', 60)
+        if delay > max_wait:
+            print ('%s: Downloading %s was rate limited for the next %d ' +
+                'seconds, giving up') % (__name__, url, delay)
+            return False
+        print ('%s: Downloading %s was rate limited, trying again in ' +
+            '%.1f seconds') % (__name__, url, delay)
+        return True
+
+
+_rate_limiter = RateLimiter()
+
+_version_date_regex = re.compile('\d{4}\.\d{2}\.\d{2}\.\d{2}\.\d{2}\.\d{2}')
+_version_zeros_regex = re.compile(r'(\.0+)*$')
+
+# The package list shown by the install and upgrade commands, sorted and
+# with version keys precomputed, so that it is only built again once the
+# repository info it came from has expired
+_package_catalog = {}
+_package_catalog_lock = threading.Lock()
+
+# Parsed package-metadata.json files, keyed by path and stored with the
+# mtime and size of the file they were read from
+_metadata_index = {}
+
+
+class DiskCache():
+    def __init__(self, path=None):
+        # The cache is kept out of the User folder, which people often sync
+        # or keep in version control
+        if path == None:
+            path = os.path.join(os.path.dirname(sublime.packages_path()),
+                'Package Control Cache')
+        self.path = path
+
+    def get_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def set(self, key, content):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        path = self.get_path(key)
+
+        # Content is written to a temp file and then renamed so that other
+        # threads never see a partially written entry
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(tmp_fd, 'wb') as f:
+            f.write(content)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+class JobScheduler():
+    def __init__(self, max_workers, max_per_group=0, group_spacing=0):
+        self.max_workers = max(1, int(max_workers))
+        # A limit of 0 means an unlimited number of jobs per group
+        self.max_per_group = max_per_group
+        # The minimum number of seconds between the start of jobs in a group
+        self.group_spacing = group_spacing
+        self.pending = []
+        self.results = []
+        self.active = {}
+        self.next_start = {}
+        self.condition = threading.Condition()
+
+    def add(self, job, group=None):
+        self.pending.append((job, group))
+
+    def find_job(self):
+        # Must be called with self.condition held. Returns the index of the
+        # first job that is allowed to start, or the number of seconds to
+        # wait before one might become available.
+        now = time.time()
+        wait = None
+        for i in range(len(self.pending)):
+            group = self.pending[i][1]
+            if group == None:
+                return i, None
+            if self.max_per_group and \
+                    self.active.get(group, 0) >= self.max_per_group:
+                continue
+            start = self.next_start.get(group, 0)
+            if start > now:
+                if wait == None or start - now < wait:
+                    wait = start - now
+                continue
+            return i, None
+        return None, wait
+
+    def worker(self, report):
+        _profiler.attach(report)
+        self.condition.acquire()
+        try:
+            while self.pending:
+                index, wait = self.find_job()
+                if index == None:
+                    # Either a group is at its concurrency limit, in which
+                    # case a finishing job will notify us, or a group has
+                    # to wait out its spacing
+                    self.condition.wait(wait)
+                    continue
+
+                job, group = self.pending.pop(index)
+                if group != None:
+                    self.active[group] = self.active.get(group, 0) + 1
+                    self.next_start[group] = time.time() + self.group_spacing
+
+                self.condition.release()
+                try:
+                    try:
+                        result = job()
+                    except (Exception) as (e):
+                        print '%s: Error running background job. %s' % (
+                            __name__, str(e))
+                        result = False
+                finally:
+                    self.condition.acquire()
+
+                if group != None:
+                    self.active[group] -= 1
+                self.results.append((job, result))
+                self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        # Blocks until every job has completed, returning a list of
+        # (job, result) tuples in the order the jobs finished
+        workers = []
+        for i in range(min(self.max_workers, len(self.pending))):
+            worker = threading.Thread(target=self.worker,
+                args=(_profiler.get_report(),))
+            workers.append(worker)
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.results
+
+
+class HostLatencies():
+    # Tracks how long each host takes to start sending a download so that
+    # mirrors can be tried fastest first
+    def __init__(self):
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def get_host(self, url):
+        return urlparse.urlparse(url)[1].lower()
+
+    def record(self, url, seconds):
+        host = self.get_host(url)
+        self.lock.acquire()
+        try:
+            # A moving average smooths out the odd slow response
+            if host in self.latencies:
+                seconds = 0.7 * self.latencies[host] + 0.3 * seconds
+            self.latencies[host] = seconds
+        finally:
+            self.lock.release()
+
+    def sort(self, urls):
+        # Hosts we have not downloaded from yet are tried first, in the
+        # order given, so that they get a latency recorded
+        self.lock.acquire()
+        try:
+            return sorted(urls, key=lambda url: self.latencies.get(
+                self.get_host(url), 0))
+        finally:
+            self.lock.release()
+
+
+_host_latencies = HostLatencies()
+
+
+class PackageLocks():
+    # Ensures that only one thread at a time installs, upgrades or removes
+    # a given package
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, package_name):
+        self.lock.acquire()
+        try:
+            if package_name not in self.locks:
+                self.locks[package_name] = threading.Lock()
+            return self.locks[package_name]
+        finally:
+            self.lock.release()
+
+
+_package_locks = PackageLocks()
+
+
+class PackageArchive():
+    # Keeps downloaded package files, named by their SHA-256 hash, so that
+    # reinstalls and rollbacks can be done without downloading anything
+    lock = threading.Lock()
+
+    def __init__(self, size_limit):
+        self.path = os.path.join(os.path.dirname(sublime.packages_path()),
+            'Package Archives')
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.size_limit = size_limit
+
+    def get_archive_path(self, sha256):
+        return os.path.join(self.path, sha256 + '.sublime-package')
+
+    def load_index(self):
+        index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            except (ValueError, IOError):
+                index = {}
+        index.setdefault('archives', {})
+        index.setdefault('history', {})
+        return index
+
+    def save_index(self, index):
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(tmp_fd, 'w') as f:
+            json.dump(index, f)
+        if os.name == 'nt' and os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(tmp_path, self.index_path)
+
+    def find(self, package, version, sha256=None):
+        # Returns the hash of an archived copy of the package version
+        if not self.size_limit or not os.path.exists(self.index_path):
+            return None
+
+        self.lock.acquire()
+        try:
+            index = self.load_index()
+            for hash, info in index['archives'].items():
+                if sha256 and hash != sha256.lower():
+                    continue
+                if info['package'] != package or info['version'] != version:
+                    continue
+                if not os.path.exists(self.get_archive_path(hash)):
+                    continue
+                info['last_used'] = time.time()
+                self.save_index(index)
+                return hash
+        finally:
+            self.lock.release()
+        return None
+
+    def add(self, path, package, version, sha256):
+        # Moves the package file at path into the archive and returns the
+        # new path, evicting the least recently used archives if necessary
+        if not self.size_limit:
+            return path
+
+        self.lock.acquire()
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            archive_path = self.get_archive_path(sha256)
+            if os.path.exists(archive_path):
+                os.remove(path)
+            else:
+                shutil.move(path, archive_path)
+
+            index = self.load_index()
+            index['archives'][sha256] = {
+                'package': package,
+                'version': version,
+                'size': os.path.getsize(archive_path),
+                'last_used': time.time()
+            }
+            self.evict(index, sha256)
+            self.save_index(index)
+            return archive_path
+        finally:
+            self.lock.release()
+
+    def evict(self, index, keep):
+        archives = index['archives']
+        total_size = sum([info['size'] for info in archives.values()])
+        by_last_used = sorted(archives.keys(),
+            key=lambda hash: archives[hash]['last_used'])
+        for hash in by_last_used:
+            if total_size <= self.size_limit:
+                break
+            if hash == keep:
+                continue
+            total_size -= archives[hash]['size']
+            del archives[hash]
+            if os.path.exists(self.get_archive_path(hash)):
+                os.remove(self.get_archive_path(hash))
+
+    def record_install(self, package, sha256, rollback=False):
+        if not self.size_limit or not os.path.exists(self.path):
+            return
+
+        self.lock.acquire()
+        try:
+            index = self.load_index()
+            history = index['history'].setdefault(package, [])
+            # A rollback drops the versions it rolled away from, so that
+            # rolling back again goes further back instead of forward
+            if rollback and sha256 in history:
+                last = len(history) - 1 - history[::-1].index(sha256)
+                del history[last + 1:]
+                self.save_index(index)
+                return
+            if history and history[-1] == sha256:
+                return
+            history.append(sha256)
+            del history[:-5]
+            self.save_index(index)
+        finally:
+            self.lock.release()
+
+    def get_previous(self, package):
+        # Returns a tuple of the hash and info of the most recent archive
+        # installed before the current one
+        self.lock.acquire()
+        try:
+            index = self.load_index()
+        finally:
+            self.lock.release()
+        history = index['history'].get(package, [])
+        for hash in reversed(history[:-1]):
+            if hash == history[-1] or hash not in index['archives']:
+                continue
+            if os.path.exists(self.get_archive_path(hash)):
+                return (hash, index['archives'][hash])
+        return None
+
+
+class UsageQueue():
+    # Usage info is submitted from a background thread so installs and
+    # removals never wait on it. Events are kept in a spool file in the
+    # User folder until the server accepts them, so they survive restarts.
+    delay = 5
+
+    def __init__(self):
+        self.events = None
+        self.manager = None
+        self.thread = None
+        self.batches_supported = True
+        self.lock = threading.Lock()
+
+    def get_path(self):
+        return os.path.join(sublime.packages_path(), 'User',
+            __name__ + '.usage')
+
+    def load(self):
+        # Must be called with self.lock held
+        if self.events != None:
+            return
+        self.events = []
+        try:
+            with open(self.get_path(), 'rb') as f:
+                self.events = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        # Must be called with self.lock held
+        path = self.get_path()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(self.events, f)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def add(self, manager, params):
+        self.lock.acquire()
+        try:
+            self.load()
+            # Back to back repeats of an event, such as the install notices
+            # sent for existing packages at startup, are only kept once.
+            # Past the size limit the oldest events are dropped.
+            if not self.events or self.events[-1] != params:
+                self.events.append(params)
+            limit = manager.settings.get('usage_queue_size', 200)
+            if len(self.events) > limit:
+                self.events = self.events[len(self.events) - limit:]
+            self.save()
+        finally:
+            self.lock.release()
+        self.start(manager)
+
+    def start(self, manager):
+        self.lock.acquire()
+        try:
+            self.manager = manager
+            self.load()
+            # Usage info waits in the queue while packages come from a mirror
+            if self.thread or not self.events or manager.get_mirror_path():
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self):
+        # The short wait lets events from a batch operation, such as
+        # upgrading all packages, go out in a single request
+        time.sleep(self.delay)
+        while True:
+            self.lock.acquire()
+            try:
+                events = list(self.events)
+                manager = self.manager
+                if not events:
+                    self.thread = None
+                    return
+            finally:
+                self.lock.release()
+
+            sent = self.submit(manager, events)
+
+            self.lock.acquire()
+            try:
+                # The same event may be queued again later, so only the
+                # oldest copy of each sent event is removed
+                for event in sent:
+                    if event in self.events:
+                        self.events.remove(event)
+                self.save()
+                # Anything left is retried with the next event or restart
+                if len(sent) < len(events):
+                    self.thread = None
+                    return
+            finally:
+                self.lock.release()
+
+    def submit(self, manager, events):
+        # Returns the list of events the server accepted
+        url = manager.settings.get('submit_url')
+        downloader = manager.get_downloader(url)
+        if not downloader:
+            return []
+        timeout = manager.settings.get('timeout', 3)
+
+        # The default submit_url only accepts single events
+        if manager.settings.get('submit_usage_batches') and \
+                self.batches_supported:
+            data = json.dumps({'events': events})
+            result = downloader.download(url,
+                'Error submitting usage information.', timeout, 3,
+                {'Content-Type': 'application/json'}, data=data)
+            if self.is_success(result):
+                return events
+
+        # Servers that don't understand batches get one request per event
+        sent = []
+        for params in events:
+            params = dict([(key, unicode(value).encode('utf-8')) for
+                key, value in params.items()])
+            result = downloader.download(url + '?' + urllib.urlencode(params),
+                'Error submitting usage information.', timeout, 3)
+            if not self.is_success(result):
+                print '%s: Error submitting usage information for %s' % \
+                    (__name__, params.get('package'))
+                break
+            sent.append(events[len(sent)])
+        if sent:
+            self.batches_supported = False
+        return sent
+
+    def is_success(self, result):
+        try:
+            return json.loads(result)['result'] == 'success'
+        except (ValueError, TypeError, KeyError):
+            return False
+
+
+_usage_queue = UsageQueue()
 
 
 class RepositoryDownloader(threading.Thread):
     def __init__(self, package_manager, name_map, repo):
         self.package_manager = package_manager
         self.repo = repo
-        self.packages = {}
+        self.packages = False
+        self.renamed_packages = False
         self.name_map = name_map
         threading.Thread.__init__(self)
 
@@ -651,23 +2438,92 @@ class RepositoryDownloader(threading.Thread):
 
 
 class VcsUpgrader():
-    def __init__(self, vcs_binary, update_command, working_copy, cache_length):
+    def __init__(self, vcs_binary, update_command, working_copy, cache_length,
+            timeout=None):
         self.binary = vcs_binary
         self.update_command = update_command
         self.working_copy = working_copy
         self.cache_length = cache_length
+        self.timeout = timeout
+        self.timed_out = False
 
     def execute(self, args, dir):
         startupinfo = None
+        preexec_fn = None
         if os.name == 'nt':
             startupinfo = subprocess.STARTUPINFO()
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        else:
+            # A new process group allows killing helpers, such as ssh, that
+            # the VCS starts and that would otherwise keep stdout open
+            preexec_fn = os.setsid
 
         proc = subprocess.Popen(args, stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            startupinfo=startupinfo, cwd=dir)
+            startupinfo=startupinfo, cwd=dir, preexec_fn=preexec_fn)
+
+        # Network operations such as fetch can hang on an unresponsive
+        # remote, so the process is killed once the timeout has passed
+        timer = None
+        if self.timeout:
+            def kill():
+                self.timed_out = True
+                try:
+                    if os.name == 'nt':
+                        proc.kill()
+                    else:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                except (OSError):
+                    pass
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+
+        output = proc.stdout.read()
+        proc.wait()
+        if timer:
+            timer.cancel()
+        return output.replace('\r\n', '\n').rstrip(' \n\r')
+
+    def incoming(self):
+        cache_key = self.working_copy + '.incoming'
+        incoming = _channel_repository_cache.get(cache_key)
+        if incoming != None:
+            return incoming
+
+        # Results are also kept on disk so they survive a restart
+        try:
+            working_copy_cache = json.loads(DiskCache().get(cache_key) or
+                '{}')
+        except (ValueError):
+            working_copy_cache = {}
+        if working_copy_cache.get('time') > time.time():
+            _channel_repository_cache.set(cache_key,
+                working_copy_cache.get('data'),
+                working_copy_cache['time'] - time.time())
+            return working_copy_cache.get('data')
+
+        return _channel_repository_cache.fetch(cache_key, self.fetch_incoming)
 
-        return proc.stdout.read().replace('\r\n', '\n').rstrip(' \n\r')
+    def fetch_incoming(self):
+        cache_key = self.working_copy + '.incoming'
+        incoming = self.check_incoming()
+        if incoming == None:
+            return False
+        if self.timed_out:
+            print '%s: Checking %s for incoming changes timed out' % (
+                __name__, self.working_copy)
+            return False
+
+        _channel_repository_cache.set(cache_key, incoming, self.cache_length)
+        try:
+            DiskCache().set(cache_key, json.dumps({
+                'time': time.time() + self.cache_length,
+                'data': incoming
+            }))
+        except (OSError, IOError) as (e):
+            print '%s: Error caching incoming changes for %s. %s' % (
+                __name__, self.working_copy, str(e))
+        return incoming
 
     def find_binary(self, name):
         if self.binary:
@@ -729,27 +2585,15 @@ class GitUpgrader(VcsUpgrader):
         self.execute(args, self.working_copy)
         return True
 
-    def incoming(self):
-        cache_key = self.working_copy + '.incoming'
-        working_copy_cache = _channel_repository_cache.get(cache_key)
-        if working_copy_cache and working_copy_cache.get('time') > \
-                time.time():
-            return working_copy_cache.get('data')
-
+    def check_incoming(self):
         binary = self.retrieve_binary()
         if not binary:
-            return False
+            return None
         self.execute([binary, 'fetch'], self.working_copy)
         args = [binary, 'log']
         args.append('..' + '/'.join(self.update_command[-2:]))
         output = self.execute(args, self.working_copy)
-        incoming = len(output) > 0
-
-        _channel_repository_cache[cache_key] = {
-            'time': time.time() + self.cache_length,
-            'data': incoming
-        }
-        return incoming
+        return len(output) > 0
 
 
 class HgUpgrader(VcsUpgrader):
@@ -781,26 +2625,14 @@ class HgUpgrader(VcsUpgrader):
         self.execute(args, self.working_copy)
         return True
 
-    def incoming(self):
-        cache_key = self.working_copy + '.incoming'
-        working_copy_cache = _channel_repository_cache.get(cache_key)
-        if working_copy_cache and working_copy_cache.get('time') > \
-                time.time():
-            return working_copy_cache.get('data')
-
+    def check_incoming(self):
         binary = self.retrieve_binary()
         if not binary:
-            return False
+            return None
         args = [binary, 'in', '-q']
         args.append(self.update_command[-1])
         output = self.execute(args, self.working_copy)
-        incoming = len(output) > 0
-
-        _channel_repository_cache[cache_key] = {
-            'time': time.time() + self.cache_length,
-            'data': incoming
-        }
-        return incoming
+        return len(output) > 0
 
 
 class PackageManager():
@@ -816,27 +2648,164 @@ class PackageManager():
                 'git_binary', 'git_update_command', 'hg_binary',
                 'hg_update_command', 'http_proxy', 'https_proxy',
                 'auto_upgrade_ignore', 'auto_upgrade_frequency',
-                'submit_usage', 'submit_url', 'renamed_packages']:
+                'submit_usage', 'submit_url', 'renamed_packages',
+                'repository_download_workers',
+                'repository_download_domain_limit',
+                'repository_download_domain_delay', 'debug',
+                'auto_upgrade_workers', 'vcs_workers', 'delta_upgrades',
+                'package_archive_size', 'rate_limited_hosts',
+                'rate_limit_requests_per_second', 'rate_limit_burst',
+                'rate_limit_max_wait', 'download_hedge_delay',
+                'package_build_workers', 'reproducible_package_builds',
+                'usage_queue_size', 'package_unload_timeout',
+                'remove_package_workers', 'startup_idle_time',
+                'package_mirror', 'performance_history',
+                'submit_usage_batches']:
             if settings.get(setting) == None:
                 continue
             self.settings[setting] = settings.get(setting)
         self.settings['platform'] = sublime.platform()
         self.settings['version'] = sublime.version()
 
+        # Content downloaded ahead of time by prefetch_urls()
+        self.prefetched = {}
+
+        # While a mirror is being created, every url downloaded is kept,
+        # along with the repositories whose packages came from a channel
+        # this manager downloaded
+        self.recorded_urls = None
+        self.recorded_repositories = set()
+
+    def get_version_key(self, version):
+        # We prepend 0 to all date-based version numbers so that developers
+        # may switch to explicit versioning from GitHub/BitBucket
+        # versioning based on commit dates
+        if _version_date_regex.match(version):
+            version = '0.' + version
+        return [int(x) for x in
+            _version_zeros_regex.sub('', version).split(".")]
+
     def compare_versions(self, version1, version2):
-        def normalize(v):
-            # We prepend 0 to all date-based version numbers so that developers
-            # may switch to explicit versioning from GitHub/BitBucket
-            # versioning based on commit dates
-            if re.match('\d{4}\.\d{2}\.\d{2}\.\d{2}\.\d{2}\.\d{2}', v):
-                v = '0.' + v
-            return [int(x) for x in re.sub(r'(\.0+)*$', '', v).split(".")]
-        return cmp(normalize(version1), normalize(version2))
-
-    def download_url(self, url, error_message):
+        return cmp(self.get_version_key(version1),
+            self.get_version_key(version2))
+
+    def get_mirror_path(self):
+        # The package_mirror setting may be a path or a file:// url
+        mirror = self.settings.get('package_mirror')
+        if not mirror:
+            return None
+        if re.search('^file://', mirror):
+            mirror = urllib.url2pathname(urlparse.urlparse(mirror)[2])
+        return os.path.expanduser(mirror)
+
+    def create_mirror(self, mirror_path, installed_only=False):
+        # Saves the channels, repositories and package files into
+        # mirror_path so that other machines can use it as package_mirror.
+        # Everything is fetched from the network, even if a mirror is set.
+        self.settings['package_mirror'] = None
+        self.recorded_urls = {}
+        self.recorded_repositories = set()
+        _channel_repository_cache.clear()
+        packages = self.list_available_packages()
+
+        urls_dir = os.path.join(mirror_path, 'urls')
+        if not os.path.exists(urls_dir):
+            os.makedirs(urls_dir)
+        mirror = MirrorDownloader(self.settings, mirror_path)
+
+        index_path = os.path.join(mirror_path, 'index.json')
+        try:
+            with open(index_path, 'rb') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        index['created'] = int(time.time())
+        index_urls = index.setdefault('urls', {})
+        index_packages = index.setdefault('packages', {})
+
+        for url in self.recorded_urls:
+            with open(mirror.get_path(url), 'wb') as f:
+                f.write(self.recorded_urls[url])
+            index_urls[url] = os.path.basename(mirror.get_path(url))
+        self.recorded_urls = None
+
+        names = packages.keys()
+        if installed_only:
+            installed_packages = set(self.list_packages())
+            names = [name for name in names if name in installed_packages]
+
+        # Package files already in the mirror with the right hash are kept,
+        # so refreshing a mirror only downloads what has changed
+        scheduler = JobScheduler(
+            self.settings.get('repository_download_workers', 8),
+            self.settings.get('repository_download_domain_limit', 4))
+        for name in names:
+            download = packages[name]['downloads'][0]
+            url = download['url'].replace(' ', '%20')
+            path = mirror.get_path(url)
+            sha256 = download.get('sha256')
+            if sha256 and os.path.exists(path) and \
+                    self.hash_file(path) == sha256.lower():
+                index_urls[url] = os.path.basename(path)
+                index_packages[name] = download['version']
+                continue
+
+            def download_package(url=url, path=path, sha256=sha256):
+                return self.download_file(url, path,
+                    'Error downloading package.', sha256)
+            download_package.name = name
+            download_package.url = url
+            domain = urlparse.urlparse(url)[1]
+            scheduler.add(download_package, domain)
+
+        failed = []
+        for job, result in scheduler.run():
+            if not result:
+                failed.append(job.name)
+                continue
+            index_urls[job.url] = os.path.basename(mirror.get_path(job.url))
+            index_packages[job.name] = packages[job.name]['downloads'][0][
+                'version']
+
+        with open(index_path, 'wb') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+
+        print '%s: Mirrored %s package files to %s' % (__name__,
+            len(names) - len(failed), mirror_path)
+        if failed or self.failed_repositories:
+            print '%s: Unable to mirror %s' % (__name__, ', '.join(failed +
+                self.failed_repositories))
+        return not failed and not self.failed_repositories
+
+    def hash_file(self, path):
+        # Package files are hashed in chunks so they are never held in
+        # memory all at once
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(StreamedDownload.chunk_size)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def fetch_shared(self, key, fetcher):
+        # While a mirror is being created every download has to go through
+        # this manager to be recorded, so one already in flight on another
+        # thread isn't shared
+        if self.recorded_urls != None:
+            return fetcher()
+        return _channel_repository_cache.fetch(key, fetcher)
+
+    def get_downloader(self, url):
+        mirror_path = self.get_mirror_path()
+        if mirror_path:
+            return MirrorDownloader(self.settings, mirror_path)
+
         has_ssl = 'ssl' in sys.modules
         is_ssl = re.search('^https://', url) != None
 
+        downloader = None
         if (is_ssl and has_ssl) or not is_ssl:
             downloader = UrlLib2Downloader(self.settings)
         else:
@@ -852,180 +2821,488 @@ class PackageManager():
                 url + ' due to no ssl module available and no capable ' +
                 'program found. Please install curl or wget.')
             return False
+        return downloader
+
+    def download_url(self, url, error_message, cache=False):
+        url = url.replace(' ', '%20')
+        result = self.fetch_url(url, error_message, cache)
+        if result != False and self.recorded_urls != None:
+            self.recorded_urls[url] = result
+        return result
+
+    def fetch_url(self, url, error_message, cache):
+        downloader = self.get_downloader(url)
+        if not downloader:
+            return False
 
+        # A response from prefetch_urls() goes through the same caching as
+        # one downloaded here
+        prefetched = self.prefetched.pop(url, None)
+
+        timeout = self.settings.get('timeout', 3)
+        if not cache:
+            if prefetched and prefetched[0] == 200:
+                return prefetched[1]
+            return downloader.download(url, error_message, timeout, 3)
+
+        # Responses are kept on disk along with their validators so that,
+        # even after a restart, the server can reply with a 304 instead of
+        # sending the full content again
+        http_cache = DiskCache()
+        validators_key = url + '.validators'
+        cached_content, headers = self.get_cache_validators(url)
+
+        if prefetched and (prefetched[0] == 200 or cached_content != False):
+            response_code, result, response_headers = prefetched
+        else:
+            result = downloader.download(url, error_message, timeout, 3,
+                headers)
+            response_code = downloader.response_code
+            response_headers = downloader.response_headers
+        if response_code == 304 and cached_content != False:
+            return cached_content
+        if result == False:
+            return False
+
+        validators = {}
+        for header in ['etag', 'last-modified']:
+            if response_headers.get(header):
+                validators[header] = response_headers[header]
+        if validators:
+            try:
+                http_cache.set(url, result)
+                http_cache.set(validators_key, json.dumps(validators))
+            except (OSError, IOError) as (e):
+                print '%s: Error caching %s. %s' % (__name__, url, str(e))
+        return result
+
+    def get_cache_validators(self, url):
+        # Returns the cached content for url, or False, and the headers to
+        # ask the server if it has changed since
+        http_cache = DiskCache()
+        cached_content = http_cache.get(url)
+        headers = {}
+        if cached_content != False:
+            try:
+                validators = json.loads(http_cache.get(url + '.validators') or
+                    '{}')
+            except (ValueError):
+                validators = {}
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                headers['If-Modified-Since'] = validators['last-modified']
+        return cached_content, headers
+
+    def prefetch_urls(self, urls):
+        # Without the ssl module, https urls are downloaded by running curl.
+        # Rather than starting a process for each, they are all fetched by
+        # one process and handed out by download_url().
+        urls = [url.replace(' ', '%20') for url in urls if
+            re.search('^https://', url)]
+        if 'ssl' in sys.modules or len(urls) < 2 or self.get_mirror_path():
+            return
+        try:
+            downloader = CurlDownloader(self.settings)
+        except (BinaryNotFoundError):
+            return
+        headers = {}
+        for url in urls:
+            headers[url] = self.get_cache_validators(url)[1]
+        self.prefetched.update(downloader.download_many(urls,
+            self.settings.get('timeout', 3),
+            self.settings.get('repository_download_workers', 8), headers))
+
+    def download_file(self, url, path, error_message, sha256=None,
+            mirrors=None):
+        if mirrors:
+            return self.download_from_mirrors([url] + mirrors, path,
+                error_message, sha256)
+
+        downloader = self.get_downloader(url)
+        if not downloader:
+            return False
+
+        url = url.replace(' ', '%20')
+        timeout = self.settings.get('timeout', 3)
+        sink = StreamedDownload(path)
+        try:
+            if downloader.download(url, error_message, timeout, 3,
+                    sink=sink) == False:
+                return False
+
+            if sha256 and sink.hexdigest() != sha256.lower():
+                sublime.error_message(('%s: %s The SHA-256 hash of %s, %s, ' +
+                    'does not match the expected hash %s.') % (__name__,
+                    error_message, url, sink.hexdigest(), sha256))
+                return False
+
+            if self.settings.get('debug') and (sink.resumed or
+                    sink.discarded):
+                print '%s: Downloading %s resumed %s bytes, refetched %s' % (
+                    __name__, url, sink.resumed, sink.discarded)
+
+            # The file is only moved into place once it is complete and
+            # verified, so a failed download never leaves a partial file
+            sink.commit()
+            return sink.hexdigest()
+        finally:
+            sink.abort()
+
+    def download_from_mirrors(self, urls, path, error_message, sha256=None):
+        # Starts with the fastest known mirror. If it hasn't sent anything
+        # after download_hedge_delay, or fails, the next mirror is started
+        # alongside it. The first verified download wins and the others are
+        # cancelled.
+        urls = _host_latencies.sort([url.replace(' ', '%20') for url in
+            urls])
         timeout = self.settings.get('timeout', 3)
-        return downloader.download(url.replace(' ', '%20'), error_message,
-            timeout, 3)
+        hedge_delay = self.settings.get('download_hedge_delay', 2000) / 1000.0
+        condition = threading.Condition()
+        attempts = []
+
+        def start_attempt(url):
+            attempt = {'url': url, 'sink': StreamedDownload(path),
+                'done': False, 'result': False}
+            attempts.append(attempt)
+
+            def run():
+                sink = attempt['sink']
+                start_time = time.time()
+                result = False
+                try:
+                    downloader = self.get_downloader(url)
+                    if downloader and downloader.download(url, error_message,
+                            timeout, 3, sink=sink) != False:
+                        result = sink.hexdigest()
+                        if sha256 and result != sha256.lower():
+                            print ('%s: %s The SHA-256 hash of %s, %s, does ' +
+                                'not match the expected hash %s.') % (
+                                __name__, error_message, url, result, sha256)
+                            result = False
+                except (DownloadCancelledError):
+                    pass
+
+                # An attempt cancelled before it sent anything took at least
+                # this long, so it isn't tried first again as an unknown host
+                if sink.first_byte_time:
+                    _host_latencies.record(url,
+                        sink.first_byte_time - start_time)
+                elif sink.cancelled:
+                    _host_latencies.record(url, time.time() - start_time)
+                else:
+                    _host_latencies.record(url, timeout)
+
+                condition.acquire()
+                try:
+                    attempt['done'] = True
+                    if sink.cancelled or not result:
+                        sink.abort()
+                    else:
+                        attempt['result'] = result
+                    condition.notify_all()
+                finally:
+                    condition.release()
+
+            thread = threading.Thread(target=run)
+            thread.start()
+            return time.time()
+
+        condition.acquire()
+        try:
+            last_start = start_attempt(urls.pop(0))
+            winner = None
+            while True:
+                finished = [attempt for attempt in attempts if
+                    attempt['result']]
+                if finished:
+                    winner = finished[0]
+                    break
+
+                running = [attempt for attempt in attempts if
+                    not attempt['done']]
+                if not running and not urls:
+                    break
+
+                wait = None
+                if urls:
+                    receiving = [attempt for attempt in running if
+                        attempt['sink'].size > 0]
+                    wait = last_start + hedge_delay - time.time()
+                    if not running or (not receiving and wait <= 0):
+                        last_start = start_attempt(urls.pop(0))
+                        continue
+                    if receiving:
+                        wait = None
+                condition.wait(wait)
+
+            for attempt in attempts:
+                if attempt != winner:
+                    attempt['sink'].cancelled = True
+                    if attempt['done']:
+                        attempt['sink'].abort()
+        finally:
+            condition.release()
+
+        if not winner:
+            return False
+
+        # The file is only moved into place once it is complete and
+        # verified, so a failed download never leaves a partial file
+        winner['sink'].commit()
+        return winner['result']
 
     def get_metadata(self, package):
         metadata_filename = os.path.join(self.get_package_dir(package),
             'package-metadata.json')
-        if os.path.exists(metadata_filename):
-            with open(metadata_filename) as f:
+        try:
+            stat = os.stat(metadata_filename)
+        except (OSError):
+            return {}
+
+        # The file is only parsed again once it has been rewritten
+        signature = (stat.st_mtime, stat.st_size)
+        cached = _metadata_index.get(metadata_filename)
+        if cached and cached[0] == signature:
+            return dict(cached[1])
+
+        with open(metadata_filename) as f:
+            try:
+                metadata = json.load(f)
+            except (ValueError):
+                metadata = {}
+        _metadata_index[metadata_filename] = (signature, metadata)
+        return dict(metadata)
+
+    def get_catalog(self):
+        # Returns a list of the available packages sorted by name, each a
+        # dict with the name, description, url, download and version_key
+        key = json.dumps([self.settings.get('repository_channels'),
+            self.settings.get('repositories'),
+            self.settings.get('package_name_map'), self.settings['platform'],
+            self.get_mirror_path()])
+
+        _package_catalog_lock.acquire()
+        try:
+            if _package_catalog.get('key') != key or \
+                    _package_catalog.get('expires') < time.time():
+                # After a restart, the catalog saved by a previous session
+                # is used while it is still fresh
                 try:
-                    return json.load(f)
+                    snapshot = json.loads(DiskCache().get('catalog') or '{}')
                 except (ValueError):
-                    return {}
-        return {}
+                    snapshot = {}
+                if snapshot.get('key') == key and \
+                        snapshot.get('expires') > time.time():
+                    _package_catalog.update(snapshot)
+
+            if _package_catalog.get('key') == key and \
+                    _package_catalog.get('expires') > time.time():
+                return _package_catalog['entries']
+
+            packages = self.list_available_packages()
+            entries = []
+            for name in sorted(packages.iterkeys(), key=lambda s: s.lower()):
+                info = packages[name]
+                download = info['downloads'][0]
+                entries.append({
+                    'name': name,
+                    'description': info.get('description') or
+                        'No description provided',
+                    'url': re.sub('^https?://', '', info['url']),
+                    'download': download,
+                    'version_key': self.get_version_key(download['version'])
+                })
+
+            # Repositories that failed to download are tried again next time
+            if self.failed_repositories:
+                return entries
+
+            _package_catalog.clear()
+            _package_catalog.update({
+                'key': key,
+                'expires': time.time() + self.settings.get('cache_length', 300),
+                'entries': entries
+            })
+            try:
+                DiskCache().set('catalog', json.dumps(_package_catalog))
+            except (OSError, IOError) as (e):
+                print '%s: Error saving the package catalog. %s' % (__name__,
+                    str(e))
+            return entries
+        finally:
+            _package_catalog_lock.release()
 
     def list_repositories(self):
-        repositories = self.settings.get('repositories')
+        # A copy is used so that concurrent calls don't extend the setting
+        repositories = list(self.settings.get('repositories', []))
         repository_channels = self.settings.get('repository_channels')
+        cache_length = self.settings.get('cache_length', 300)
         for channel in repository_channels:
-            channel_repositories = None
-
             cache_key = channel + '.repositories'
-            repositories_cache = _channel_repository_cache.get(cache_key)
-            if repositories_cache and repositories_cache.get('time') > \
-                    time.time():
-                channel_repositories = repositories_cache.get('data')
-
             name_map_cache_key = channel + '.package_name_map'
-            name_map_cache = _channel_repository_cache.get(
-                name_map_cache_key)
-            if name_map_cache and name_map_cache.get('time') > \
-                    time.time():
-                name_map = name_map_cache.get('data')
-                name_map.update(self.settings.get('package_name_map', {}))
-                self.settings['package_name_map'] = name_map
-
             renamed_cache_key = channel + '.renamed_packages'
-            renamed_cache = _channel_repository_cache.get(
-                renamed_cache_key)
-            if renamed_cache and renamed_cache.get('time') > \
-                    time.time():
-                renamed_packages = renamed_cache.get('data')
-                renamed_packages.update(self.settings.get('renamed_packages',
-                    {}))
-                self.settings['renamed_packages'] = renamed_packages
-
-            if channel_repositories == None or \
-                    self.settings.get('package_name_map') == None or \
-                    self.settings.get('renamed_packages') == None:
+
+            def fetch_channel(channel=channel, cache_key=cache_key,
+                    name_map_cache_key=name_map_cache_key,
+                    renamed_cache_key=renamed_cache_key):
                 for provider_class in _channel_providers:
                     provider = provider_class(channel, self)
                     if provider.match_url():
                         break
 
                 channel_repositories = provider.get_repositories()
-
                 if channel_repositories == False:
-                    continue
-                _channel_repository_cache[cache_key] = {
-                    'time': time.time() + self.settings.get('cache_length',
-                        300),
-                    'data': channel_repositories
-                }
+                    return False
 
                 for repo in channel_repositories:
-                    if provider.get_packages(repo) == False:
+                    repository_packages = provider.get_packages(repo)
+                    if repository_packages == False:
                         continue
-                    packages_cache_key = repo + '.packages'
-                    _channel_repository_cache[packages_cache_key] = {
-                        'time': time.time() + self.settings.get('cache_length',
-                            300),
-                        'data': provider.get_packages(repo)
-                    }
+                    _channel_repository_cache.set(repo + '.packages',
+                        repository_packages, cache_length)
+                    if self.recorded_urls != None:
+                        self.recorded_repositories.add(repo)
+
+                _channel_repository_cache.set(name_map_cache_key,
+                    provider.get_name_map(), cache_length)
+                _channel_repository_cache.set(renamed_cache_key,
+                    provider.get_renamed_packages(), cache_length)
+                _channel_repository_cache.set(cache_key,
+                    channel_repositories, cache_length)
+                return channel_repositories
+
+            channel_repositories = _channel_repository_cache.get(cache_key)
+            name_map = _channel_repository_cache.get(name_map_cache_key)
+            renamed_packages = _channel_repository_cache.get(renamed_cache_key)
+            # Channels fetched by other managers aren't used while
+            # recording a mirror, since their files weren't recorded
+            if channel_repositories == None or name_map == None or \
+                    renamed_packages == None or self.recorded_urls != None:
+                # If another thread is already downloading the channel, this
+                # waits for it and uses its result
+                channel_repositories = self.fetch_shared(cache_key,
+                    fetch_channel)
+                if channel_repositories == False:
+                    continue
+                name_map = _channel_repository_cache.get(name_map_cache_key)
+                renamed_packages = _channel_repository_cache.get(
+                    renamed_cache_key)
 
-                # Have the local name map override the one from the channel
-                name_map = provider.get_name_map()
-                name_map.update(self.settings.get('package_name_map', {}))
-                self.settings['package_name_map'] = name_map
-                _channel_repository_cache[name_map_cache_key] = {
-                    'time': time.time() + self.settings.get('cache_length',
-                        300),
-                    'data': name_map
-                }
+            # Have the local name map override the one from the channel
+            name_map = dict(name_map or {})
+            name_map.update(self.settings.get('package_name_map', {}))
+            self.settings['package_name_map'] = name_map
 
-                renamed_packages = provider.get_renamed_packages()
-                _channel_repository_cache[renamed_cache_key] = {
-                    'time': time.time() + self.settings.get('cache_length',
-                        300),
-                    'data': renamed_packages
-                }
-                if renamed_packages:
-                    self.settings['renamed_packages'] = self.settings.get(
-                        'renamed_packages', {})
-                    self.settings['renamed_packages'].update(renamed_packages)
+            if renamed_packages:
+                self.settings['renamed_packages'] = self.settings.get(
+                    'renamed_packages', {})
+                self.settings['renamed_packages'].update(renamed_packages)
 
             repositories.extend(channel_repositories)
         return repositories
 
     def list_available_packages(self):
+        with _profiler.operation('list_available_packages', '',
+                self.settings):
+            try:
+                return self.do_list_available_packages()
+            finally:
+                # Prefetched files are only used for this refresh, so that
+                # later ones revalidate against the server
+                self.prefetched.clear()
+
+    def do_list_available_packages(self):
+        _profiler.phase('list repositories')
         repositories = self.list_repositories()
         packages = {}
-        downloaders = []
-        grouped_downloaders = {}
+        cache_length = self.settings.get('cache_length', 300)
+        name_map = self.settings.get('package_name_map', {})
+
+        # Requests to a single domain are limited and spaced out so that
+        # GitHub and BitBucket don't rate limit us
+        scheduler = JobScheduler(
+            self.settings.get('repository_download_workers', 8),
+            self.settings.get('repository_download_domain_limit', 4),
+            self.settings.get('repository_download_domain_delay', 150) / 1000.0)
 
-        # Repositories are run in reverse order so that the ones first
+        # Repositories are merged in reverse order so that the ones first
         # on the list will overwrite those last on the list
+        repository_packages = {}
+        prefetch_urls = []
         for repo in repositories[::-1]:
-            repository_packages = None
-
-            cache_key = repo + '.packages'
-            packages_cache = _channel_repository_cache.get(cache_key)
-            if packages_cache and packages_cache.get('time') > \
-                    time.time():
-                repository_packages = packages_cache.get('data')
-                packages.update(repository_packages)
-
-            if repository_packages == None:
-                downloader = RepositoryDownloader(self,
-                    self.settings.get('package_name_map', {}), repo)
-                domain = re.sub('^https?://[^/]*?(\w+\.\w+)($|/.*$)', '\\1',
-                    repo)
-                if not grouped_downloaders.get(domain):
-                    grouped_downloaders[domain] = []
-                grouped_downloaders[domain].append(downloader)
-
-        def schedule(downloader, delay):
-            downloader.has_started = False
-
-            def inner():
-                downloader.start()
-                downloader.has_started = True
-            sublime.set_timeout(inner, delay)
-
-        for domain_downloaders in grouped_downloaders.values():
-            for i in range(len(domain_downloaders)):
-                downloader = domain_downloaders[i]
-                downloaders.append(downloader)
-                schedule(downloader, i * 150)
-
-        complete = []
-
-        while downloaders:
-            downloader = downloaders.pop()
-            if downloader.has_started:
-                downloader.join()
-                complete.append(downloader)
-            else:
-                downloaders.insert(0, downloader)
-
-        for downloader in complete:
-            repository_packages = downloader.packages
-            if repository_packages == False:
+            cached_packages = _channel_repository_cache.get(
+                repo + '.packages')
+            if cached_packages != None and (self.recorded_urls == None or
+                    repo in self.recorded_repositories):
+                repository_packages[repo] = cached_packages
                 continue
-            cache_key = downloader.repo + '.packages'
-            _channel_repository_cache[cache_key] = {
-                'time': time.time() + self.settings.get('cache_length', 300),
-                'data': repository_packages
-            }
-            packages.update(repository_packages)
 
-            renamed_packages = downloader.renamed_packages
-            if renamed_packages == False:
+            def fetch_repository(repo=repo):
+                downloader = RepositoryDownloader(self, name_map, repo)
+                downloader.run()
+                if downloader.packages == False:
+                    return False
+                if downloader.renamed_packages != False:
+                    _channel_repository_cache.set(repo + '.renamed_packages',
+                        downloader.renamed_packages, cache_length)
+                _channel_repository_cache.set(repo + '.packages',
+                    downloader.packages, cache_length)
+                return downloader.packages
+
+            def download_repository(repo=repo, fetch=fetch_repository):
+                # If another thread is already downloading the repository,
+                # this waits for it and uses its result
+                return self.fetch_shared(repo + '.packages', fetch)
+            download_repository.repo = repo
+
+            for provider_class in _package_providers:
+                if provider_class(repo, self).match_url():
+                    break
+            if provider_class == PackageProvider:
+                prefetch_urls.append(repo)
+
+            domain = re.sub('^https?://[^/]*?(\w+\.\w+)($|/.*$)', '\\1',
+                repo)
+            scheduler.add(download_repository, domain)
+
+        # Repository JSON files that don't need an API are all downloaded
+        # up front, which saves a process per file when using curl
+        _profiler.phase('prefetch')
+        self.prefetch_urls(prefetch_urls)
+
+        _profiler.phase('download repositories')
+        for job, result in scheduler.run():
+            repository_packages[job.repo] = result
+
+        _profiler.phase('merge')
+        # The results are merged in repository order, rather than completion
+        # order, so that the precedence of repositories is kept
+        self.failed_repositories = []
+        for repo in repositories[::-1]:
+            if repository_packages.get(repo) == False:
+                self.failed_repositories.append(repo)
                 continue
-            renamed_cache_key = downloader.repo + '.renamed_packages'
-            _channel_repository_cache[renamed_cache_key] = {
-                'time': time.time() + self.settings.get('cache_length', 300),
-                'data': renamed_packages
-            }
+            packages.update(repository_packages[repo])
+
+            renamed_packages = _channel_repository_cache.get(
+                repo + '.renamed_packages')
             if renamed_packages:
                 self.settings['renamed_packages'] = self.settings.get(
                     'renamed_packages', {})
                 self.settings['renamed_packages'].update(renamed_packages)
 
+        if self.settings.get('debug'):
+            print '%s: %s HTTP connections opened, %s reused' % (__name__,
+                _connection_pool.created, _connection_pool.reused)
+            print '%s: Received %s bytes of JSON, %s bytes decompressed' % (
+                __name__, _transfer_stats.wire, _transfer_stats.decoded)
+            print ('%s: Repository cache %s hits, %s misses, %s requests ' +
+                'shared an in-flight download') % (__name__,
+                _channel_repository_cache.hits,
+                _channel_repository_cache.misses,
+                _channel_repository_cache.coalesced)
+
         return packages
 
     def list_packages(self):
@@ -1081,49 +3358,227 @@ class PackageManager():
         if not os.path.exists(sublime.installed_packages_path()):
             os.mkdir(sublime.installed_packages_path())
 
-        if os.path.exists(package_path):
-            os.remove(package_path)
-
-        try:
-            package_file = zipfile.ZipFile(package_path, "w",
-                compression=zipfile.ZIP_DEFLATED)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred ' +
-                'creating the package file %s in %s. %s' % (package_filename,
-                package_destination, str(exception)))
-            return False
-
         dirs_to_ignore = self.settings.get('dirs_to_ignore', [])
         if not binary_package:
             files_to_ignore = self.settings.get('files_to_ignore', [])
         else:
             files_to_ignore = self.settings.get('files_to_ignore_binary', [])
 
-        package_dir_regex = re.compile('^' + re.escape(package_dir))
-        for root, dirs, files in os.walk(package_dir):
-            [dirs.remove(dir) for dir in dirs if dir in dirs_to_ignore]
-            paths = dirs
-            paths.extend(files)
-            for path in paths:
-                if any(fnmatch.fnmatch(path, pattern) for pattern in
-                        files_to_ignore):
-                    continue
-                full_path = os.path.join(root, path)
-                relative_path = re.sub(package_dir_regex, '', full_path)
-                if os.path.isdir(full_path):
-                    continue
-                package_file.write(full_path, relative_path)
+        # The patterns are combined into a single regex so that each path is
+        # only matched once. fnmatch is case-insensitive on Windows.
+        ignore_regex = None
+        if files_to_ignore:
+            ignore_regex = re.compile('|'.join(['(?:%s)' %
+                fnmatch.translate(pattern) for pattern in files_to_ignore]),
+                re.I if os.name == 'nt' else 0)
+
+        # Maps each path in the zip to the file it is built from. Binary
+        # packages get .pyc files compiled fresh from the .py files instead
+        # of whatever .pyc files happen to be in the package folder.
+        sources = {}
+        compiled = {}
+        for root, dirs, files in os.walk(package_dir):
+            dirs[:] = [dir for dir in dirs if dir not in dirs_to_ignore]
+            for path in files:
+                full_path = os.path.join(root, path)
+                relative_path = full_path[len(package_dir):].replace(
+                    os.sep, '/')
+                if binary_package and path.endswith('.py'):
+                    if not ignore_regex or not ignore_regex.match(path + 'c'):
+                        sources[relative_path + 'c'] = full_path
+                        compiled[relative_path + 'c'] = True
+                    if relative_path == '__init__.py':
+                        sources[relative_path] = full_path
+                    continue
+                if ignore_regex and ignore_regex.match(path):
+                    continue
+                if binary_package and path.endswith('.pyc') and \
+                        os.path.exists(full_path[:-1]):
+                    continue
+                sources[relative_path] = full_path
+
+        # Reproducible builds use a fixed timestamp and permissions for
+        # every entry so the same source always gives the same bytes
+        reproducible = bool(self.settings.get('reproducible_package_builds'))
+
+        # Entries whose source file is unchanged since the last build are
+        # copied, still compressed, out of the previous package file
+        cache = DiskCache()
+        cache_key = os.path.abspath(package_path) + '.build'
+        manifest = {}
+        manifest_json = cache.get(cache_key)
+        if manifest_json:
+            try:
+                manifest = json.loads(manifest_json)
+            except (ValueError):
+                pass
+
+        previous_file = None
+        previous_zip = None
+        if manifest and os.path.exists(package_path):
+            try:
+                previous_file = open(package_path, 'rb')
+                previous_zip = zipfile.ZipFile(previous_file)
+            except (zipfile.BadZipfile, IOError):
+                previous_zip = None
+
+        scheduler = JobScheduler(self.settings.get('package_build_workers', 4))
+        names = sorted(sources.keys())
+        infos = {}
+        members = {}
+        new_manifest = {}
+        try:
+            for name in names:
+                full_path = sources[name]
+                stat = os.stat(full_path)
+                info = zipfile.ZipInfo(name)
+                if reproducible:
+                    info.date_time = (1980, 1, 1, 0, 0, 0)
+                    info.create_system = 3
+                    info.external_attr = 0644 << 16
+                else:
+                    info.date_time = time.localtime(stat.st_mtime)[0:6]
+                    info.external_attr = (stat.st_mode & 0xFFFF) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                infos[name] = info
+                new_manifest[name] = [stat.st_mtime, stat.st_size,
+                    reproducible]
+
+                previous = manifest.get(name)
+                if previous_zip and previous and \
+                        previous[0:3] == new_manifest[name] and \
+                        name in previous_zip.NameToInfo:
+                    previous_info = previous_zip.getinfo(name)
+                    if previous_info.CRC == previous[3] and \
+                            previous_info.compress_type == zipfile.ZIP_DEFLATED:
+                        info.CRC = previous_info.CRC
+                        info.file_size = previous_info.file_size
+                        info.compress_size = previous_info.compress_size
+                        members[name] = self.read_zip_member(previous_file,
+                            previous_info)
+                        continue
+
+                def build(name=name, full_path=full_path,
+                        mtime=int(stat.st_mtime)):
+                    try:
+                        if compiled.get(name):
+                            with open(full_path, 'rU') as f:
+                                data = self.compile_python(f.read(),
+                                    package_name + '/' + name[:-1],
+                                    0 if reproducible else mtime)
+                        else:
+                            with open(full_path, 'rb') as f:
+                                data = f.read()
+                    except (SyntaxError, IOError, OSError) as (e):
+                        return '%s: %s' % (name, str(e))
+                    info = infos[name]
+                    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                        zlib.DEFLATED, -15)
+                    members[name] = compressor.compress(data) + \
+                        compressor.flush()
+                    info.CRC = zlib.crc32(data) & 0xffffffff
+                    info.file_size = len(data)
+                    info.compress_size = len(members[name])
+                    return True
+                scheduler.add(build)
+        finally:
+            if previous_file:
+                previous_file.close()
+        reused = len(members)
+
+        # zlib releases the GIL while compressing, so the members are
+        # compressed on several threads at once
+        for job, result in scheduler.run():
+            if result != True:
+                sublime.error_message(__name__ + ': An error occurred ' +
+                    'creating the package file %s in %s. %s' % (
+                    package_filename, package_destination,
+                    result or 'Error compressing files.'))
+                return False
+
+        # The package is written to a temp file and renamed over the old one
+        # once complete, since the old one is read above
+        tmp_path = package_path + '.tmp'
+        try:
+            package_file = zipfile.ZipFile(tmp_path, "w",
+                compression=zipfile.ZIP_DEFLATED)
+            for name in names:
+                self.write_zip_member(package_file, infos[name], members[name])
+                new_manifest[name].append(infos[name].CRC)
+            package_file.close()
+            if os.path.exists(package_path):
+                os.remove(package_path)
+            os.rename(tmp_path, package_path)
+        except (OSError, IOError) as (exception):
+            sublime.error_message(__name__ + ': An error occurred ' +
+                'creating the package file %s in %s. %s' % (package_filename,
+                package_destination, str(exception)))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        cache.set(cache_key, json.dumps(new_manifest))
 
-        init_script = os.path.join(package_dir, '__init__.py')
-        if binary_package and os.path.exists(init_script):
-            package_file.write(init_script, re.sub(package_dir_regex, '',
-                init_script))
-        package_file.close()
+        if self.settings.get('debug'):
+            print '%s: Compressed %s files and reused %s unchanged files for %s' % (
+                __name__, len(names) - reused, reused, package_name)
 
         return True
 
-    def install_package(self, package_name):
-        packages = self.list_available_packages()
+    def compile_python(self, source, filename, mtime):
+        # Produces the contents of a .pyc file the same way py_compile does
+        if source and source[-1] != '\n':
+            source += '\n'
+        code = compile(source, filename, 'exec')
+        return imp.get_magic() + struct.pack('<I', mtime & 0xffffffff) + \
+            marshal.dumps(code)
+
+    def read_zip_member(self, zip_file, info):
+        # Returns the raw compressed bytes of a member, skipping over the
+        # local file header
+        zip_file.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+            zip_file.read(zipfile.sizeFileHeader))
+        zip_file.seek(header[zipfile._FH_FILENAME_LENGTH] +
+            header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        return zip_file.read(info.compress_size)
+
+    def write_zip_member(self, package_file, info, compressed):
+        # Writes an already compressed member, the same way
+        # ZipFile.writestr() does after compressing the data itself
+        info.header_offset = package_file.fp.tell()
+        package_file._didModify = True
+        package_file.fp.write(info.FileHeader())
+        package_file.fp.write(compressed)
+        package_file.filelist.append(info)
+        package_file.NameToInfo[info.filename] = info
+
+    def install_package(self, package_name, save_settings=True,
+            packages=None, action=None):
+        # A PackageTransaction passes in its snapshot of the available
+        # packages so they aren't fetched again for each package, along
+        # with the action it planned for the package
+        with _profiler.operation('install_package', package_name,
+                self.settings):
+            _profiler.phase('wait for lock')
+            lock = _package_locks.get(package_name)
+            lock.acquire()
+            try:
+                return self.do_install_package(package_name, save_settings,
+                    packages, action)
+            finally:
+                lock.release()
+
+    def do_install_package(self, package_name, save_settings, packages,
+            action):
+        package_dir = self.get_package_dir(package_name)
+        if action == 'pull':
+            _profiler.phase('vcs pull')
+            return self.pull_package(package_dir)
+
+        if packages == None:
+            _profiler.phase('list available packages')
+            packages = self.list_available_packages()
 
         if package_name not in packages.keys():
             sublime.error_message(__name__ + ': The package specified,' +
@@ -1133,59 +3588,116 @@ class PackageManager():
         download = packages[package_name]['downloads'][0]
         url = download['url']
 
+        # Other downloads of the same version, and any listed mirrors, are
+        # used as alternate sources for the package file
+        mirrors = list(download.get('mirrors', []))
+        for other in packages[package_name]['downloads'][1:]:
+            if other['version'] == download['version'] and \
+                    other['url'] not in mirrors and other['url'] != url:
+                mirrors.append(other['url'])
+
         package_filename = package_name + \
             '.sublime-package'
         package_path = os.path.join(sublime.installed_packages_path(),
             package_filename)
-        pristine_package_path = os.path.join(os.path.dirname(
-            sublime.packages_path()), 'Pristine Packages', package_filename)
 
-        package_dir = self.get_package_dir(package_name)
+        # Without a planned action, VCS checkouts are still pulled rather
+        # than overwritten
+        if action == None and self.is_vcs_package(package_dir):
+            _profiler.phase('vcs pull')
+            return self.pull_package(package_dir)
 
-        package_metadata_file = os.path.join(package_dir,
-            'package-metadata.json')
+        if not os.path.exists(sublime.installed_packages_path()):
+            os.mkdir(sublime.installed_packages_path())
+
+        # Package files we have already downloaded are installed from the
+        # archive without going to the network
+        _profiler.phase('archive lookup')
+        archive = self.get_archive()
+        sha256 = archive.find(package_name, download['version'],
+            download.get('sha256'))
+        if sha256:
+            archive_path = archive.get_archive_path(sha256)
+        else:
+            _profiler.phase('download')
+            sha256 = self.download_file(url, package_path,
+                'Error downloading package.', download.get('sha256'),
+                mirrors)
+            if not sha256:
+                return False
+            _profiler.phase('archive add')
+            archive_path = archive.add(package_path, package_name,
+                download['version'], sha256)
+
+        metadata = {
+            "version": download['version'],
+            "url": packages[package_name]['url'],
+            "description": packages[package_name]['description']
+        }
+        return self.extract_package(package_name, archive_path, sha256,
+            metadata, save_settings)
+
+    def is_vcs_package(self, package_dir):
+        return os.path.exists(os.path.join(package_dir, '.git')) or \
+            os.path.exists(os.path.join(package_dir, '.hg'))
 
+    def pull_package(self, package_dir):
         if os.path.exists(os.path.join(package_dir, '.git')):
             return GitUpgrader(self.settings['git_binary'],
                 self.settings['git_update_command'], package_dir,
                 self.settings['cache_length']).run()
-        elif os.path.exists(os.path.join(package_dir, '.hg')):
-            return HgUpgrader(self.settings['hg_binary'],
-                self.settings['hg_update_command'], package_dir,
-                self.settings['cache_length']).run()
+        return HgUpgrader(self.settings['hg_binary'],
+            self.settings['hg_update_command'], package_dir,
+            self.settings['cache_length']).run()
+
+    def rollback_package(self, package_name):
+        lock = _package_locks.get(package_name)
+        lock.acquire()
+        try:
+            archive = self.get_archive()
+            previous = archive.get_previous(package_name)
+            if not previous:
+                sublime.error_message(__name__ + ': There is no previous ' +
+                    'version of %s available to roll back to.' %
+                    (package_name,))
+                return False
+
+            sha256, info = previous
+            metadata = self.get_metadata(package_name)
+            metadata['version'] = info['version']
+            return self.extract_package(package_name,
+                archive.get_archive_path(sha256), sha256, metadata, True,
+                True)
+        finally:
+            lock.release()
+
+    def get_archive(self):
+        return PackageArchive(self.settings.get('package_archive_size', 100) *
+            1024 * 1024)
+
+    def extract_package(self, package_name, package_path, sha256, metadata,
+            save_settings, rollback=False):
+        package_filename = package_name + '.sublime-package'
+        installed_package_path = os.path.join(
+            sublime.installed_packages_path(), package_filename)
+        pristine_package_path = os.path.join(os.path.dirname(
+            sublime.packages_path()), 'Pristine Packages', package_filename)
+
+        package_dir = self.get_package_dir(package_name)
+
+        package_metadata_file = os.path.join(package_dir,
+            'package-metadata.json')
 
         is_upgrade = os.path.exists(package_metadata_file)
         old_version = None
         if is_upgrade:
             old_version = self.get_metadata(package_name).get('version')
 
-        package_bytes = self.download_url(url, 'Error downloading package.')
-        if package_bytes == False:
-            return False
-        with open(package_path, "wb") as package_file:
-            package_file.write(package_bytes)
-
-        if not os.path.exists(package_dir):
-            os.mkdir(package_dir)
-
-        # We create a backup copy incase something was edited
-        else:
-            try:
-                backup_dir = os.path.join(os.path.dirname(
-                    sublime.packages_path()), 'Backup',
-                    datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
-                if not os.path.exists(backup_dir):
-                    os.makedirs(backup_dir)
-                package_backup_dir = os.path.join(backup_dir, package_name)
-                shutil.copytree(package_dir, package_backup_dir)
-            except (OSError, IOError) as (exception):
-                sublime.error_message(__name__ + ': An error occurred while' +
-                    ' trying to backup the package directory for %s. %s' %
-                    (package_name, str(exception)))
-                shutil.rmtree(package_backup_dir)
-                return False
-
-        package_zip = zipfile.ZipFile(package_path, 'r')
+        # Passing an open file keeps ZipFile.open() from reopening the
+        # package file for every member
+        _profiler.phase('extract files')
+        package_file = open(package_path, 'rb')
+        package_zip = zipfile.ZipFile(package_file, 'r')
         root_level_paths = []
         last_path = None
         for path in package_zip.namelist():
@@ -1196,116 +3708,190 @@ class PackageManager():
                 sublime.error_message(__name__ + ': The package ' +
                     'specified, %s, contains files outside of the package ' +
                     'dir and cannot be safely installed.' % (package_name,))
+                package_zip.close()
+                package_file.close()
                 return False
 
         if last_path and len(root_level_paths) == 0:
             root_level_paths.append(last_path[0:last_path.find('/') + 1])
 
-        os.chdir(package_dir)
+        # The package is extracted into a staging folder next to the
+        # Packages folder, where Sublime Text won't load it, and then
+        # swapped into place with renames. A failure part way through
+        # never leaves a half-written package behind.
+        staging_root = os.path.join(os.path.dirname(sublime.packages_path()),
+            'Package Control Staging')
+        if not os.path.exists(staging_root):
+            os.makedirs(staging_root)
+        staging_dir = tempfile.mkdtemp(dir=staging_root)
+
+        # With delta upgrades, files that haven't changed are hard linked
+        # from the current package instead of being written again
+        delta = self.settings.get('delta_upgrades', True) and \
+            hasattr(os, 'link') and os.path.exists(package_dir)
 
         # Here we don’t use .extractall() since it was having issues on OS X
         skip_root_dir = len(root_level_paths) == 1 and \
             root_level_paths[0].endswith('/')
-        extracted_paths = []
-        for path in package_zip.namelist():
-            dest = path
-            try:
-                if not isinstance(dest, unicode):
-                    dest = unicode(dest, 'utf-8', 'strict')
-            except (UnicodeDecodeError):
-                dest = unicode(dest, 'cp1252', 'replace')
-
-            if os.name == 'nt':
-                regex = ':|\*|\?|"|<|>|\|'
-                if re.search(regex, dest) != None:
-                    print ('%s: Skipping file from package ' +
-                        'named %s due to an invalid filename') % (__name__,
-                        path)
-                    continue
+        extracted_files = 0
+        linked_files = 0
+        try:
+            for info in package_zip.infolist():
+                path = info.filename
+                dest = path
+                try:
+                    if not isinstance(dest, unicode):
+                        dest = unicode(dest, 'utf-8', 'strict')
+                except (UnicodeDecodeError):
+                    dest = unicode(dest, 'cp1252', 'replace')
+
+                if os.name == 'nt':
+                    regex = ':|\*|\?|"|<|>|\|'
+                    if re.search(regex, dest) != None:
+                        print ('%s: Skipping file from package ' +
+                            'named %s due to an invalid filename') % (
+                            __name__, path)
+                        continue
 
-            # If there was only a single directory in the package, we remove
-            # that folder name from the paths as we extract entries
-            if skip_root_dir:
-                dest = dest[len(root_level_paths[0]):]
+                # If there was only a single directory in the package, we
+                # remove that folder name from the paths as we extract entries
+                if skip_root_dir:
+                    dest = dest[len(root_level_paths[0]):]
 
-            if os.name == 'nt':
-                dest = dest.replace('/', '\\')
-            else:
-                dest = dest.replace('\\', '/')
+                if os.name == 'nt':
+                    dest = dest.replace('/', '\\')
+                else:
+                    dest = dest.replace('\\', '/')
 
-            dest = os.path.join(package_dir, dest)
+                current_path = os.path.join(package_dir, dest)
+                dest = os.path.join(staging_dir, dest)
 
-            def add_extracted_dirs(dir):
-                while dir not in extracted_paths:
-                    extracted_paths.append(dir)
-                    dir = os.path.dirname(dir)
-                    if dir == package_dir:
-                        break
+                if path.endswith('/'):
+                    if not os.path.exists(dest):
+                        os.makedirs(dest)
+                    continue
 
-            if path.endswith('/'):
-                if not os.path.exists(dest):
-                    os.makedirs(dest)
-                add_extracted_dirs(dest)
-            else:
                 dest_dir = os.path.dirname(dest)
                 if not os.path.exists(dest_dir):
                     os.makedirs(dest_dir)
-                add_extracted_dirs(dest_dir)
-                extracted_paths.append(dest)
+
+                if delta and self.file_matches_zip_info(current_path, info):
+                    try:
+                        os.link(current_path, dest)
+                        linked_files += 1
+                        continue
+                    except (OSError):
+                        pass
+
+                # Members are copied in chunks so that large files are never
+                # held in memory all at once
                 try:
-                    open(dest, 'wb').write(package_zip.read(path))
+                    source = package_zip.open(info)
+                    try:
+                        with open(dest, 'wb') as f:
+                            shutil.copyfileobj(source, f,
+                                StreamedDownload.chunk_size)
+                    finally:
+                        source.close()
+                    extracted_files += 1
                 except (IOError, UnicodeDecodeError):
                     print ('%s: Skipping file from package ' +
                         'named %s due to an invalid filename') % (__name__,
                         path)
-        package_zip.close()
-
-        # Here we clean out any files that were not just overwritten
-        try:
-            for root, dirs, files in os.walk(package_dir, topdown=False):
-                paths = [os.path.join(root, f) for f in files]
-                paths.extend([os.path.join(root, d) for d in dirs])
+        except (OSError, IOError, zipfile.BadZipfile) as (e):
+            shutil.rmtree(staging_dir, True)
+            sublime.error_message(('%s: An error occurred while trying to ' +
+                'extract the package %s. %s') % (__name__, package_name,
+                str(e)))
+            return False
+        finally:
+            package_zip.close()
+            package_file.close()
 
-                for path in paths:
-                    if path in extracted_paths:
-                        continue
-                    if os.path.isdir(path):
-                        os.rmdir(path)
-                    else:
-                        os.remove(path)
+        _profiler.count('files extracted', extracted_files)
+        _profiler.count('files linked', linked_files)
 
-        except (OSError, IOError) as (e):
+        # The old package directory becomes the backup, which is much
+        # cheaper than copying it
+        _profiler.phase('replace directory')
+        package_backup_dir = None
+        try:
+            if os.path.exists(package_dir):
+                backup_dir = os.path.join(os.path.dirname(
+                    sublime.packages_path()), 'Backup',
+                    datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+                # Upgrades running at the same time share the folder, so
+                # another one may create it first
+                try:
+                    os.makedirs(backup_dir)
+                except (OSError):
+                    if not os.path.isdir(backup_dir):
+                        raise
+                package_backup_dir = os.path.join(backup_dir, package_name)
+                suffix = 1
+                while os.path.exists(package_backup_dir):
+                    suffix += 1
+                    package_backup_dir = os.path.join(backup_dir,
+                        '%s (%s)' % (package_name, suffix))
+                os.rename(package_dir, package_backup_dir)
+            os.rename(staging_dir, package_dir)
+        except (OSError) as (e):
+            if package_backup_dir and os.path.exists(package_backup_dir) and \
+                    not os.path.exists(package_dir):
+                os.rename(package_backup_dir, package_dir)
+            shutil.rmtree(staging_dir, True)
             sublime.error_message(('%s: An error occurred while trying to ' +
-                'remove old files from the %s directory. %s') %
-                (__name__, package_name, str(e)))
+                'replace the %s directory. %s') % (__name__, package_name,
+                str(e)))
             return False
 
+        # With delta upgrades, the files that are the same in the new
+        # version are removed from the backup in the background, so only
+        # the files that were overwritten or removed are kept. When
+        # profiling, the size of the backup is measured there too.
+        prune = self.settings.get('delta_upgrades', True)
+        report = _profiler.get_report()
+        if package_backup_dir and (prune or report):
+            if report:
+                report.hold()
+            threading.Thread(target=self.prune_backup,
+                args=(package_backup_dir, package_dir, prune,
+                report)).start()
+
+        if self.settings.get('debug'):
+            print '%s: Extracted %s files and kept %s unchanged files for %s' % (
+                __name__, extracted_files, linked_files, package_name)
+
+        _profiler.phase('print messages')
         self.print_messages(package_name, package_dir, is_upgrade, old_version)
 
+        _profiler.phase('save metadata')
         with open(package_metadata_file, 'w') as f:
-            metadata = {
-                "version": packages[package_name]['downloads'][0]['version'],
-                "url": packages[package_name]['url'],
-                "description": packages[package_name]['description']
-            }
             json.dump(metadata, f)
+        _metadata_index.pop(package_metadata_file, None)
+
+        self.get_archive().record_install(package_name, sha256, rollback)
+
+        _profiler.phase('record usage')
 
         # Submit install and upgrade info
         if is_upgrade:
             params = {
                 'package': package_name,
                 'operation': 'upgrade',
-                'version': packages[package_name]['downloads'][0]['version'],
+                'version': metadata['version'],
                 'old_version': old_version
             }
         else:
             params = {
                 'package': package_name,
                 'operation': 'install',
-                'version': packages[package_name]['downloads'][0]['version']
+                'version': metadata['version']
             }
         self.record_usage(params)
 
+        _profiler.phase('finish')
+
         # Record the install in the settings file so that you can move
         # settings across computers and have the same packages installed
         def save_package():
@@ -1319,19 +3905,68 @@ class PackageManager():
                 key=lambda s: s.lower())
             settings.set('installed_packages', installed_packages)
             sublime.save_settings(__name__ + '.sublime-settings')
-        sublime.set_timeout(save_package, 1)
+        if save_settings:
+            sublime.set_timeout(save_package, 1)
 
         # Here we delete the package file from the installed packages directory
         # since we don't want to accidentally overwrite user changes
-        os.remove(package_path)
+        if os.path.exists(installed_package_path):
+            os.remove(installed_package_path)
         # We have to remove the pristine package too or else Sublime Text 2
         # will silently delete the package
         if os.path.exists(pristine_package_path):
             os.remove(pristine_package_path)
 
-        os.chdir(sublime.packages_path())
         return True
 
+    def file_matches_zip_info(self, path, info):
+        # The size is checked first since it is much cheaper than the CRC
+        try:
+            if os.path.getsize(path) != info.file_size:
+                return False
+            crc = 0
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+        except (OSError, IOError):
+            return False
+        return (crc & 0xffffffff) == (info.CRC & 0xffffffff)
+
+    def prune_backup(self, package_backup_dir, package_dir, prune=True,
+            report=None):
+        _profiler.attach(report)
+        try:
+            for root, dirs, files in os.walk(package_backup_dir,
+                    topdown=False):
+                for file in files:
+                    path = os.path.join(root, file)
+                    new_path = os.path.join(package_dir,
+                        os.path.relpath(path, package_backup_dir))
+                    # Unchanged files were hard linked into the new package
+                    if prune and os.path.isfile(new_path) and (
+                            os.path.samefile(path, new_path) or
+                            filecmp.cmp(path, new_path, False)):
+                        os.remove(path)
+                        _profiler.count('backup files pruned')
+                    elif report:
+                        _profiler.count('bytes backed up',
+                            os.path.getsize(path))
+                if prune and not os.listdir(root):
+                    os.rmdir(root)
+            # The parent Backup/<timestamp> folder may be shared with an
+            # upgrade that is moving its package into it right now, so an
+            # empty one is left for PackageCleanup to remove at startup
+        except (OSError, IOError) as (e):
+            print '%s: Error cleaning up the backup %s. %s' % (__name__,
+                package_backup_dir, str(e))
+        finally:
+            _profiler.attach(None)
+            if report:
+                report.release()
+
     def print_messages(self, package, package_dir, is_upgrade, old_version):
         messages_file = os.path.join(package_dir, 'messages.json')
         if not os.path.exists(messages_file):
@@ -1402,94 +4037,178 @@ class PackageManager():
         sublime.set_timeout(print_to_panel, 1)
 
     def remove_package(self, package_name):
-        installed_packages = self.list_packages()
-
-        if package_name not in installed_packages:
-            sublime.error_message(__name__ + ': The package specified,' +
-                ' %s, is not installed.' % (package_name,))
-            return False
-
-        os.chdir(sublime.packages_path())
-
-        # Give Sublime Text some time to ignore the package
-        time.sleep(1)
-
-        package_filename = package_name + '.sublime-package'
-        package_path = os.path.join(sublime.installed_packages_path(),
-            package_filename)
-        installed_package_path = os.path.join(os.path.dirname(
-            sublime.packages_path()), 'Installed Packages', package_filename)
-        pristine_package_path = os.path.join(os.path.dirname(
-            sublime.packages_path()), 'Pristine Packages', package_filename)
-        package_dir = self.get_package_dir(package_name)
+        return self.remove_packages([package_name])[package_name]
 
-        version = self.get_metadata(package_name).get('version')
+    def remove_packages(self, package_names):
+        # Removes several packages at once, returning a dict of the package
+        # name to True or False for if it was removed
+        with _profiler.operation('remove_packages', ', '.join(package_names),
+                self.settings):
+            return self.do_remove_packages(package_names)
 
-        try:
-            if os.path.exists(package_path):
-                os.remove(package_path)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred while' +
-                ' trying to remove the package file for %s. %s' %
-                (package_name, str(exception)))
-            return False
-
-        try:
-            if os.path.exists(installed_package_path):
-                os.remove(installed_package_path)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred while' +
-                ' trying to remove the installed package file for %s. %s' %
-                (package_name, str(exception)))
-            return False
+    def do_remove_packages(self, package_names):
+        installed_packages = self.list_packages()
+        results = {}
+        for package_name in package_names:
+            if package_name not in installed_packages:
+                sublime.error_message(__name__ + ': The package specified,' +
+                    ' %s, is not installed.' % (package_name,))
+                results[package_name] = False
+        package_names = [package_name for package_name in package_names if
+            package_name not in results]
+        if not package_names:
+            return results
+
+        # Give Sublime Text time to ignore the packages, which unloads their
+        # plugins. Packages without plugins don't need to wait.
+        _profiler.phase('wait for unload')
+        start = time.time()
+        loaded = self.wait_for_unload(package_names,
+            self.settings.get('package_unload_timeout', 2))
+        if self.settings.get('debug'):
+            print '%s: Waited %.2fs for packages to unload%s' % (__name__,
+                time.time() - start, ', %s still loaded' % ', '.join(loaded)
+                if loaded else '')
+
+        versions = {}
+        for package_name in package_names:
+            versions[package_name] = self.get_metadata(package_name).get(
+                'version')
+
+        _profiler.phase('delete files')
+        scheduler = JobScheduler(self.settings.get('remove_package_workers', 4))
+        for package_name in package_names:
+            def remove(package_name=package_name):
+                return self.delete_package_files(package_name)
+            remove.package_name = package_name
+            scheduler.add(remove)
+
+        removed = []
+        finished = scheduler.run()
+        _profiler.phase('record usage')
+        for job, result in finished:
+            # None means the package was removed but some locked files were
+            # left for the next start to clean up
+            results[job.package_name] = result is not False
+            if result is False:
+                continue
+            removed.append(job.package_name)
 
-        try:
-            if os.path.exists(pristine_package_path):
-                os.remove(pristine_package_path)
-        except (OSError, IOError) as (exception):
-            sublime.error_message(__name__ + ': An error occurred while' +
-                ' trying to remove the pristine package file for %s. %s' %
-                (package_name, str(exception)))
-            return False
+            params = {
+                'package': job.package_name,
+                'operation': 'remove',
+                'version': versions[job.package_name]
+            }
+            self.record_usage(params)
 
-        # We don't delete the actual package dir immediately due to a bug
-        # in sublime_plugin.py
-        can_delete_dir = True
-        for path in os.listdir(package_dir):
-            try:
-                full_path = os.path.join(package_dir, path)
-                if not os.path.isdir(full_path):
-                    os.remove(full_path)
-                else:
-                    shutil.rmtree(full_path)
-            except (OSError, IOError) as (exception):
-                # If there is an error deleting now, we will mark it for
-                # cleanup the next time Sublime Text starts
-                open(os.path.join(package_dir, 'package-control.cleanup'),
-                    'w').close()
-                can_delete_dir = False
-
-        params = {
-            'package': package_name,
-            'operation': 'remove',
-            'version': version
-        }
-        self.record_usage(params)
+        _profiler.phase('finish')
 
-        # Remove the package from the installed packages list
-        def clear_package():
+        # Remove the packages from the installed packages list
+        def clear_packages():
             settings = sublime.load_settings(__name__ + '.sublime-settings')
             installed_packages = settings.get('installed_packages', [])
             if not installed_packages:
                 installed_packages = []
-            installed_packages.remove(package_name)
+            for package_name in removed:
+                if package_name in installed_packages:
+                    installed_packages.remove(package_name)
             settings.set('installed_packages', installed_packages)
             sublime.save_settings(__name__ + '.sublime-settings')
-        sublime.set_timeout(clear_package, 1)
+        if removed:
+            sublime.set_timeout(clear_packages, 1)
+
+        # We don't delete the actual package dirs until the end due to a bug
+        # in sublime_plugin.py
+        for job, result in scheduler.results:
+            if result == True:
+                os.rmdir(self.get_package_dir(job.package_name))
+
+        return results
+
+    def wait_for_unload(self, package_names, timeout):
+        # Polls until none of the packages have plugins loaded, returning
+        # the names of any that are still loaded once the timeout passes
+        package_dirs = {}
+        for package_name in package_names:
+            package_dirs[package_name] = os.path.abspath(
+                self.get_package_dir(package_name)) + os.sep
+
+        end = time.time() + timeout
+        while True:
+            plugin_paths = []
+            objects = []
+            for classes in getattr(sublime_plugin, 'all_command_classes', []):
+                objects.extend(classes)
+            for callbacks in getattr(sublime_plugin, 'all_callbacks',
+                    {}).values():
+                objects.extend(callbacks)
+            for plugin in objects:
+                module = sys.modules.get(getattr(plugin, '__module__', None))
+                path = getattr(module, '__file__', None)
+                if path:
+                    plugin_paths.append(os.path.abspath(path))
+
+            loaded = []
+            for package_name in package_names:
+                package_dir = package_dirs[package_name]
+                for path in plugin_paths:
+                    if path.startswith(package_dir):
+                        loaded.append(package_name)
+                        break
+
+            if not loaded or time.time() >= end:
+                return loaded
+            time.sleep(0.05)
 
-        if can_delete_dir:
-            os.rmdir(package_dir)
+    def delete_package_files(self, package_name):
+        # Returns True if everything was deleted, None if some files were
+        # locked and have been left for the next start, or False on error
+        package_filename = package_name + '.sublime-package'
+        package_paths = [
+            (os.path.join(sublime.installed_packages_path(),
+                package_filename), 'package file'),
+            (os.path.join(os.path.dirname(sublime.packages_path()),
+                'Installed Packages', package_filename),
+                'installed package file'),
+            (os.path.join(os.path.dirname(sublime.packages_path()),
+                'Pristine Packages', package_filename),
+                'pristine package file')
+        ]
+        for path, description in package_paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except (OSError, IOError) as (exception):
+                sublime.error_message(__name__ + ': An error occurred while' +
+                    ' trying to remove the %s for %s. %s' % (description,
+                    package_name, str(exception)))
+                return False
 
+        # Everything that can be deleted is, and only the paths that are in
+        # use are left to be cleaned up the next time Sublime Text starts
+        package_dir = self.get_package_dir(package_name)
+        locked_paths = []
+        for root, dirs, files in os.walk(package_dir, topdown=False):
+            for path in files:
+                try:
+                    os.remove(os.path.join(root, path))
+                    _profiler.count('files deleted')
+                except (OSError, IOError):
+                    locked_paths.append(os.path.join(root, path))
+            if root == package_dir:
+                continue
+            try:
+                os.rmdir(root)
+            except (OSError):
+                if not [path for path in locked_paths if
+                        path.startswith(root + os.sep)]:
+                    locked_paths.append(root)
+
+        if locked_paths:
+            with open(os.path.join(package_dir, 'package-control.cleanup'),
+                    'w') as f:
+                f.write('\n'.join(locked_paths))
+            return None
         return True
 
     def record_usage(self, params):
@@ -1499,15 +4218,84 @@ class PackageManager():
             self.get_metadata('Package Control').get('version')
         params['sublime_platform'] = self.settings.get('platform')
         params['sublime_version'] = self.settings.get('version')
-        url = self.settings.get('submit_url') + '?' + urllib.urlencode(params)
-        result = self.download_url(url, 'Error submitting usage information.')
-        try:
-            result = json.loads(result)
-            if result['result'] != 'success':
-                raise ValueError()
-        except (ValueError):
-            print '%s: Error submitting usage information for %s' % \
-                (__name__, params['package'])
+        _usage_queue.add(self, params)
+
+
+class PackageTransaction():
+    # Installs and upgrades a batch of packages against one snapshot of the
+    # available packages, instead of fetching the list for each package
+    def __init__(self, manager):
+        self.manager = manager
+        self.packages = manager.list_available_packages()
+        self.operations = []
+        self.results = {}
+
+    def get_action(self, package_name):
+        if package_name not in self.packages:
+            return 'skip'
+        package_dir = self.manager.get_package_dir(package_name)
+        if self.manager.is_vcs_package(package_dir):
+            return 'pull'
+        if not os.path.exists(package_dir):
+            return 'install'
+        version = self.manager.get_metadata(package_name).get('version')
+        if not version:
+            return 'overwrite'
+        res = self.manager.compare_versions(version,
+            self.packages[package_name]['downloads'][0]['version'])
+        if res < 0:
+            return 'upgrade'
+        elif res > 0:
+            return 'downgrade'
+        return 'reinstall'
+
+    def add(self, package_name):
+        # Plans the operation for the package, returning the action
+        action = self.get_action(package_name)
+        if action == 'skip':
+            print ('%s: Skipping package %s since it is not available from ' +
+                'any repository') % (__name__, package_name)
+        self.operations.append((package_name, action))
+        return action
+
+    def run(self, workers=1, save_settings=True):
+        # Carries out the planned actions, returning a list of the packages
+        # that were installed or upgraded
+        scheduler = JobScheduler(workers)
+        for package_name, action in self.operations:
+            if action == 'skip':
+                continue
+            def install(package_name=package_name, action=action):
+                return self.manager.install_package(package_name,
+                    save_settings, self.packages, action)
+            install.package_name = package_name
+            scheduler.add(install)
+
+        for job, result in scheduler.run():
+            self.results[job.package_name] = bool(result)
+        return [package_name for package_name, action in self.operations if
+            self.results.get(package_name)]
+
+    # The past tense of each action, in the order they are summarized
+    summary_labels = [('install', 'installed'), ('upgrade', 'upgraded'),
+        ('downgrade', 'downgraded'), ('reinstall', 'reinstalled'),
+        ('overwrite', 'overwritten'), ('pull', 'pulled'),
+        ('skip', 'skipped')]
+
+    def get_summary(self):
+        counts = {}
+        failed = 0
+        for package_name, action in self.operations:
+            if action != 'skip' and not self.results.get(package_name):
+                failed += 1
+                continue
+            counts[action] = counts.get(action, 0) + 1
+        parts = ['%s %s' % (counts[action], label) for action, label in
+            self.summary_labels if action in counts]
+        if failed:
+            parts.append('%s failed' % failed)
+        return '%s: Package transaction finished: %s' % (__name__,
+            ', '.join(parts) or 'nothing to do')
 
 
 class PackageCreator():
@@ -1571,16 +4359,22 @@ class PackageInstaller():
 
     def make_package_list(self, ignore_actions=[], override_action=None,
             ignore_packages=[]):
-        packages = self.manager.list_available_packages()
-        installed_packages = self.manager.list_packages()
+        catalog = self.manager.get_catalog()
+        installed_packages = set(self.manager.list_packages())
+
+        vcs_incoming = {}
+        if not override_action:
+            vcs_incoming = self.check_vcs_incoming([entry['name'] for entry in
+                catalog if entry['name'] in installed_packages and
+                not (ignore_packages and entry['name'] in ignore_packages)])
 
         package_list = []
-        for package in sorted(packages.iterkeys(), key=lambda s: s.lower()):
+        for entry in catalog:
+            package = entry['name']
             if ignore_packages and package in ignore_packages:
                 continue
             package_entry = [package]
-            info = packages[package]
-            download = info['downloads'][0]
+            download = entry['download']
 
             if package in installed_packages:
                 installed = True
@@ -1597,26 +4391,14 @@ class PackageInstaller():
             new_version = 'v' + download['version']
 
             vcs = None
-            package_dir = self.manager.get_package_dir(package)
-            settings = self.manager.settings
 
             if override_action:
                 action = override_action
                 extra = ''
 
             else:
-                if os.path.exists(os.path.join(sublime.packages_path(),
-                        package, '.git')):
-                    vcs = 'git'
-                    incoming = GitUpgrader(settings.get('git_binary'),
-                        settings.get('git_update_command'), package_dir,
-                        settings.get('cache_length')).incoming()
-                elif os.path.exists(os.path.join(sublime.packages_path(),
-                        package, '.hg')):
-                    vcs = 'hg'
-                    incoming = HgUpgrader(settings.get('hg_binary'),
-                        settings.get('hg_update_command'), package_dir,
-                        settings.get('cache_length')).incoming()
+                if package in vcs_incoming:
+                    vcs, incoming = vcs_incoming[package]
 
                 if installed:
                     if not installed_version:
@@ -1632,8 +4414,8 @@ class PackageInstaller():
                             extra = ' %s with %s' % (installed_version_name,
                                 new_version)
                     else:
-                        res = self.manager.compare_versions(
-                            installed_version, download['version'])
+                        res = cmp(self.manager.get_version_key(
+                            installed_version), entry['version_key'])
                         if res < 0:
                             action = 'upgrade'
                             extra = ' to %s from %s' % (new_version,
@@ -1653,13 +4435,44 @@ class PackageInstaller():
                 if action in ignore_actions:
                     continue
 
-            package_entry.append(info.get('description', 'No description ' +
-                'provided'))
-            package_entry.append(action + extra + ' ' +
-                re.sub('^https?://', '', info['url']))
+            package_entry.append(entry['description'])
+            package_entry.append(action + extra + ' ' + entry['url'])
             package_list.append(package_entry)
         return package_list
 
+    def check_vcs_incoming(self, packages):
+        # Each check runs a VCS command that goes over the network, so they
+        # are run at the same time and each is limited by the timeout
+        settings = self.manager.settings
+        scheduler = JobScheduler(settings.get('vcs_workers', 4))
+        for package in packages:
+            package_dir = self.manager.get_package_dir(package)
+            if os.path.exists(os.path.join(package_dir, '.git')):
+                upgrader = GitUpgrader(settings.get('git_binary'),
+                    settings.get('git_update_command'), package_dir,
+                    settings.get('cache_length'), settings.get('timeout'))
+                vcs = 'git'
+            elif os.path.exists(os.path.join(package_dir, '.hg')):
+                upgrader = HgUpgrader(settings.get('hg_binary'),
+                    settings.get('hg_update_command'), package_dir,
+                    settings.get('cache_length'), settings.get('timeout'))
+                vcs = 'hg'
+            else:
+                continue
+
+            def check(upgrader=upgrader):
+                return upgrader.incoming()
+            check.package = package
+            check.vcs = vcs
+            scheduler.add(check)
+
+        # A check that failed still marks the package as a working copy, so
+        # it is never offered to be overwritten
+        vcs_incoming = {}
+        for job, result in scheduler.run():
+            vcs_incoming[job.package] = (job.vcs, bool(result))
+        return vcs_incoming
+
     def on_done(self, picked):
         if picked == -1:
             return
@@ -1680,6 +4493,20 @@ class PackageInstallerThread(threading.Thread):
         self.result = self.manager.install_package(self.package)
 
 
+class PackageTransactionThread(threading.Thread):
+    def __init__(self, transaction):
+        self.transaction = transaction
+        threading.Thread.__init__(self)
+
+    def run(self):
+        self.transaction.run(self.transaction.manager.settings.get(
+            'auto_upgrade_workers', 4))
+        self.result = not [package_name for package_name in
+            self.transaction.results if not
+            self.transaction.results[package_name]]
+        print self.transaction.get_summary()
+
+
 class InstallPackageCommand(sublime_plugin.WindowCommand):
     def run(self):
         thread = InstallPackageThread(self.window)
@@ -1764,11 +4591,16 @@ class UpgradeAllPackagesThread(threading.Thread, PackageInstaller):
         PackageInstaller.__init__(self)
 
     def run(self):
-        for info in self.make_package_list(['install', 'reinstall', 'none']):
-            thread = PackageInstallerThread(self.manager, info[0])
-            thread.start()
-            ThreadProgress(thread, 'Upgrading package %s' % info[0],
-                'Package %s successfully %s' % (info[0], self.completion_type))
+        package_list = self.make_package_list(['install', 'reinstall', 'none'])
+        if not package_list:
+            return
+        transaction = PackageTransaction(self.manager)
+        for info in package_list:
+            transaction.add(info[0])
+        thread = PackageTransactionThread(transaction)
+        thread.start()
+        ThreadProgress(thread, 'Upgrading %s packages' % len(package_list),
+            'Packages successfully %s' % self.completion_type)
 
 
 class ExistingPackagesCommand():
@@ -1889,7 +4721,8 @@ class RemovePackageThread(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
-        self.result = self.manager.remove_package(self.package)
+        self.result = self.manager.remove_packages([self.package])[
+            self.package]
 
         def unignore_package():
             settings = sublime.load_settings('Global.sublime-settings')
@@ -1898,6 +4731,83 @@ class RemovePackageThread(threading.Thread):
         sublime.set_timeout(unignore_package, 10)
 
 
+class RollbackPackageCommand(sublime_plugin.WindowCommand,
+        ExistingPackagesCommand):
+    def __init__(self, window):
+        self.window = window
+        ExistingPackagesCommand.__init__(self)
+
+    def run(self):
+        archive = self.manager.get_archive()
+        self.package_list = [entry for entry in
+            self.make_package_list('roll back') if
+            archive.get_previous(entry[0])]
+        if not self.package_list:
+            sublime.error_message(__name__ + ': There are no packages ' +
+                'that can be rolled back.')
+            return
+        self.window.show_quick_panel(self.package_list, self.on_done)
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        package = self.package_list[picked][0]
+        thread = RollbackPackageThread(self.manager, package)
+        thread.start()
+        ThreadProgress(thread, 'Rolling back package %s' % package,
+            'Package %s successfully rolled back' % package)
+
+
+class RollbackPackageThread(threading.Thread):
+    def __init__(self, manager, package):
+        self.manager = manager
+        self.package = package
+        threading.Thread.__init__(self)
+
+    def run(self):
+        self.result = self.manager.rollback_package(self.package)
+
+
+class CreateMirrorCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        self.manager = PackageManager()
+        mirror_path = self.manager.get_mirror_path() or os.path.join(
+            os.path.expanduser('~'), 'Package Control Mirror')
+        self.window.show_input_panel('Mirror Folder', mirror_path,
+            self.on_done, None, None)
+
+    def on_done(self, input):
+        self.mirror_path = os.path.expanduser(input)
+        self.options = [
+            ['Mirror installed packages',
+                'Package files for the packages that are installed'],
+            ['Mirror all packages',
+                'Package files for every available package']
+        ]
+        self.window.show_quick_panel(self.options, self.on_pick)
+
+    def on_pick(self, picked):
+        if picked == -1:
+            return
+        thread = CreateMirrorThread(self.manager, self.mirror_path,
+            picked == 0)
+        thread.start()
+        ThreadProgress(thread, 'Creating mirror in %s' % self.mirror_path,
+            'Mirror successfully created in %s' % self.mirror_path)
+
+
+class CreateMirrorThread(threading.Thread):
+    def __init__(self, manager, mirror_path, installed_only):
+        self.manager = manager
+        self.mirror_path = mirror_path
+        self.installed_only = installed_only
+        threading.Thread.__init__(self)
+
+    def run(self):
+        self.result = self.manager.create_mirror(self.mirror_path,
+            self.installed_only)
+
+
 class AddRepositoryChannelCommand(sublime_plugin.WindowCommand):
     def run(self):
         self.window.show_input_panel('Repository Channel JSON URL', '',
@@ -1999,7 +4909,47 @@ class EnablePackageCommand(sublime_plugin.WindowCommand):
             'required')
 
 
+class UserActivity(sublime_plugin.EventListener):
+    # Records when the user last did something in the editor, so startup
+    # work can wait for a quiet moment. Nothing is recorded once the
+    # startup stages have finished.
+    last = 0
+    recording = True
+
+    def on_activated(self, view):
+        if UserActivity.recording:
+            UserActivity.last = time.time()
+
+    def on_modified(self, view):
+        if UserActivity.recording:
+            UserActivity.last = time.time()
+
+    def on_selection_modified(self, view):
+        if UserActivity.recording:
+            UserActivity.last = time.time()
+
+
 class PackageStartup():
+    # The longest a startup stage will wait for the user to stop typing
+    max_idle_wait = 30
+
+    def wait_for_idle(self):
+        idle_time = self.manager.settings.get('startup_idle_time', 1)
+        end = time.time() + self.max_idle_wait
+        while time.time() < end and \
+                time.time() - UserActivity.last < idle_time:
+            time.sleep(0.25)
+
+    def run_stage(self, name, stage):
+        # Each stage waits for the editor to be idle and is timed so the
+        # cost of startup shows in the console
+        self.wait_for_idle()
+        start = time.time()
+        result = stage()
+        print '%s: Startup stage "%s" took %.3fs' % (__name__, name,
+            time.time() - start)
+        return result
+
     def load_settings(self):
         self.settings_file = '%s.sublime-settings' % __name__
         self.settings = sublime.load_settings(self.settings_file)
@@ -2047,14 +4997,18 @@ class AutomaticUpgrader(threading.Thread, PackageStartup):
         threading.Thread.__init__(self)
 
     def run(self):
-        self.install_missing()
+        # This is the last part of startup
+        try:
+            self.run_stage('install missing packages', self.install_missing)
 
-        if self.next_run > time.time():
-            self.print_skip()
-            return
+            if self.next_run > time.time():
+                self.print_skip()
+                return
 
-        self.rename_packages()
-        self.upgrade_packages()
+            self.run_stage('rename packages', self.rename_packages)
+            self.run_stage('upgrade packages', self.upgrade_packages)
+        finally:
+            UserActivity.recording = False
 
     def install_missing(self):
         if not self.missing_packages:
@@ -2062,10 +5016,13 @@ class AutomaticUpgrader(threading.Thread, PackageStartup):
 
         print '%s: Installing %s missing packages' % \
             (__name__, len(self.missing_packages))
+        transaction = PackageTransaction(self.manager)
         for package in self.missing_packages:
-            self.installer.manager.install_package(package)
+            transaction.add(package)
+        for package in transaction.run():
             print '%s: Installed missing package %s' % \
                 (__name__, package)
+        print transaction.get_summary()
 
     def print_skip(self):
         last_run = datetime.datetime.fromtimestamp(self.last_run)
@@ -2085,6 +5042,7 @@ class AutomaticUpgrader(threading.Thread, PackageStartup):
         installed_pkgs = self.installed_packages
 
         # Rename directories for packages that have changed names
+        packages_to_remove = []
         for package_name in renamed_packages:
             package_dir = os.path.join(sublime.packages_path(), package_name)
             metadata_path = os.path.join(package_dir, 'package-metadata.json')
@@ -2099,15 +5057,20 @@ class AutomaticUpgrader(threading.Thread, PackageStartup):
                 print '%s: Renamed %s to %s' % (__name__, package_name,
                     new_package_name)
             else:
-                self.installer.manager.remove_package(package_name)
-                print ('%s: Removed %s since package with new name (%s) ' +
-                    'already exists') % (__name__, package_name,
-                    new_package_name)
+                packages_to_remove.append((package_name, new_package_name))
             try:
                 installed_pkgs.remove(package_name)
             except (ValueError):
                 pass
 
+        if packages_to_remove:
+            self.installer.manager.remove_packages([package_name for
+                package_name, new_package_name in packages_to_remove])
+            for package_name, new_package_name in packages_to_remove:
+                print ('%s: Removed %s since package with new name (%s) ' +
+                    'already exists') % (__name__, package_name,
+                    new_package_name)
+
         sublime.set_timeout(lambda: self.save_packages(installed_pkgs), 10)
 
     def upgrade_packages(self):
@@ -2136,13 +5099,28 @@ class AutomaticUpgrader(threading.Thread, PackageStartup):
             return
 
         print '%s: Installing %s upgrades' % (__name__, len(packages))
+        transaction = PackageTransaction(self.manager)
+        for package in packages:
+            transaction.add(package[0])
+        upgraded = transaction.run(self.manager.settings.get(
+            'auto_upgrade_workers', 4), save_settings=False)
+
         for package in packages:
-            self.installer.manager.install_package(package[0])
+            if package[0] not in upgraded:
+                print '%s: Unable to upgrade %s' % (__name__, package[0])
+                continue
             version = re.sub('^.*?(v[\d\.]+).*?$', '\\1', package[2])
             if version == package[2] and version.find('pull with') != -1:
                 vcs = re.sub('^pull with (\w+).*?$', '\\1', version)
                 version = 'latest %s commit' % vcs
             print '%s: Upgraded %s to %s' % (__name__, package[0], version)
+        print transaction.get_summary()
+
+        # The settings are saved once, rather than after each package, since
+        # the upgrades may finish in any order
+        if upgraded:
+            installed_pkgs = self.installed_packages + upgraded
+            sublime.set_timeout(lambda: self.save_packages(installed_pkgs), 10)
 
 
 class PackageCleanup(threading.Thread, PackageStartup):
@@ -2152,34 +5130,86 @@ class PackageCleanup(threading.Thread, PackageStartup):
         threading.Thread.__init__(self)
 
     def run(self):
-        found_pkgs = []
-        installed_pkgs = self.installed_packages
+        self.found_pkgs = []
+        self.new_pkgs = []
+        self.cleanup_pkgs = []
+
+        self.run_stage('scan packages', self.scan_packages)
+        self.run_stage('remove old directories', self.remove_cleanup_dirs)
+        self.run_stage('remove empty backups', self.remove_empty_backups)
+        self.run_stage('submit usage', self.submit_usage)
+
+        installed_pkgs = self.installed_packages + self.new_pkgs
+        found_pkgs = self.found_pkgs
+        sublime.set_timeout(lambda: self.finish(installed_pkgs, found_pkgs), 10)
+
+    def scan_packages(self):
+        # A single listing of each package folder tells us both if it was
+        # marked for cleanup and if it has metadata
         for package_name in os.listdir(sublime.packages_path()):
             package_dir = os.path.join(sublime.packages_path(), package_name)
-            metadata_path = os.path.join(package_dir, 'package-metadata.json')
+            try:
+                contents = set(os.listdir(package_dir))
+            except (OSError):
+                contents = set()
 
             # Cleanup packages that could not be removed due to in-use files
-            if os.path.exists(os.path.join(package_dir,
-                    'package-control.cleanup')):
-                shutil.rmtree(package_dir)
-                print '%s: Removed old directory for package %s' % \
-                    (__name__, package_name)
+            if 'package-control.cleanup' in contents:
+                self.cleanup_pkgs.append(package_name)
 
             # This adds previously installed packages from old versions of PC
-            if os.path.exists(metadata_path) and \
+            elif 'package-metadata.json' in contents and \
                     package_name not in self.installed_packages:
-                installed_pkgs.append(package_name)
-                params = {
-                    'package': package_name,
-                    'operation': 'install',
-                    'version': \
-                        self.manager.get_metadata(package_name).get('version')
-                }
-                self.manager.record_usage(params)
+                self.new_pkgs.append(package_name)
 
-            found_pkgs.append(package_name)
+            self.found_pkgs.append(package_name)
 
-        sublime.set_timeout(lambda: self.finish(installed_pkgs, found_pkgs), 10)
+    def remove_cleanup_dirs(self):
+        for package_name in self.cleanup_pkgs:
+            package_dir = os.path.join(sublime.packages_path(), package_name)
+            try:
+                shutil.rmtree(package_dir)
+            except (OSError) as (e):
+                print '%s: Unable to remove old directory for package %s. %s' % (
+                    __name__, package_name, str(e))
+                continue
+            print '%s: Removed old directory for package %s' % \
+                (__name__, package_name)
+
+        # Older versions kept the download cache in the User folder
+        old_cache_dir = os.path.join(sublime.packages_path(), 'User',
+            __name__ + '.cache')
+        if os.path.exists(old_cache_dir):
+            shutil.rmtree(old_cache_dir, True)
+
+    def remove_empty_backups(self):
+        # Backups emptied by delta upgrades leave their timestamp folder
+        backup_root = os.path.join(os.path.dirname(sublime.packages_path()),
+            'Backup')
+        if not os.path.isdir(backup_root):
+            return
+        for name in os.listdir(backup_root):
+            backup_dir = os.path.join(backup_root, name)
+            try:
+                if os.path.isdir(backup_dir) and not os.listdir(backup_dir):
+                    os.rmdir(backup_dir)
+            except (OSError):
+                pass
+
+    def submit_usage(self):
+        for package_name in self.new_pkgs:
+            params = {
+                'package': package_name,
+                'operation': 'install',
+                'version': \
+                    self.manager.get_metadata(package_name).get('version')
+            }
+            self.manager.record_usage(params)
+
+        # Sends any usage info that was still queued when Sublime Text was
+        # last closed
+        if self.manager.settings.get('submit_usage'):
+            _usage_queue.start(self.manager)
 
     def finish(self, installed_pkgs, found_pkgs):
         self.save_packages(installed_pkgs)
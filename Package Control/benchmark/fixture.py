@@ -0,0 +1,569 @@
+# A local HTTP server that stands in for a channel, the repositories it
+# lists and the package files they point to. Package Control is pointed at
+# it with the http_proxy setting, so every host in the synthetic channel is
+# served from one port, each with its own latency and rate limit.
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import json
+import gzip
+import hashlib
+import zipfile
+import urlparse
+import StringIO
+import math
+import socket
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 512
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately, which Nagle's algorithm
+        # would otherwise delay until the client acknowledges the headers
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.fixture.open_connection(self.connection)
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.server.fixture.close_connection(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fixture.handle(self)
+
+    def do_POST(self):
+        length = self.headers.get('content-length', '0')
+        if length.isdigit():
+            self.rfile.read(int(length))
+        self.server.fixture.handle(self)
+
+
+class Fixture():
+    # The options each host starts with. latency is the number of seconds
+    # before a response starts. Past rate_limit requests in a
+    # rate_limit_window, a host responds with a 429 and Retry-After, or with
+    # a 403 and X-RateLimit-Reset when rate_limit_style is 'reset'.
+    # drop_after closes the connection after that many bytes of each full
+    # package file response.
+    default_host_options = {
+        'latency': 0,
+        'rate_limit': 0,
+        'rate_limit_window': 60,
+        'rate_limit_style': 'retry-after',
+        'drop_after': 0
+    }
+
+    def __init__(self, repositories=100, packages_per_repository=30,
+            embedded_repositories=None, hosts=8, files_per_package=10,
+            file_size=2048, gzip=True, etags=True, sync=False, sha256=False,
+            mirrors=None, host_options=None):
+        self.repositories = repositories
+        self.packages_per_repository = packages_per_repository
+        # The repositories whose packages are included in the channel, the
+        # rest have to be downloaded from their own host
+        if embedded_repositories == None:
+            embedded_repositories = repositories
+        self.embedded_repositories = embedded_repositories
+        self.hosts = max(1, hosts)
+        self.files_per_package = files_per_package
+        self.file_size = file_size
+        self.gzip = gzip
+        self.etags = etags
+        self.sync = sync
+        self.sha256 = sha256
+        # Hosts that serve a copy of every package file
+        self.mirrors = mirrors or []
+
+        self.host_options = {}
+        for host, options in (host_options or {}).items():
+            self.set_host(host, **options)
+
+        self.channel_url = 'http://channel.test/repositories.json'
+        self.submit_url = 'http://usage.test/submit'
+
+        # name: [repository index, version number]
+        self.packages = {}
+        self.repository_packages = []
+        for repo in range(repositories):
+            names = []
+            for i in range(packages_per_repository):
+                name = 'BenchPackage%05d' % (repo * packages_per_repository + i)
+                self.packages[name] = [repo, 0]
+                names.append(name)
+            self.repository_packages.append(names)
+
+        # The package versions at each sync token, to build deltas from
+        self.revision = 1
+        self.history = {self.revision: self.get_versions()}
+
+        self.lock = threading.Lock()
+        self.content_cache = {}
+        self.zip_cache = {}
+        self.rate_limits = {}
+        self.server = None
+        self.open_sockets = set()
+        self.reset_stats()
+
+    def set_host(self, host, **options):
+        host_options = self.host_options.setdefault(host,
+            dict(self.default_host_options))
+        for name, value in options.items():
+            if name not in self.default_host_options:
+                raise ValueError('Unknown host option %s' % name)
+            host_options[name] = value
+
+    def get_host_options(self, host):
+        return self.host_options.get(host, self.default_host_options)
+
+    def start(self):
+        self.server = FixtureServer(('127.0.0.1', 0), FixtureHandler)
+        self.server.fixture = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.proxy = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        return self.proxy
+
+    def stop(self):
+        if not self.server:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+        # Connections kept alive by the client are closed so their threads
+        # finish before the interpreter exits
+        self.lock.acquire()
+        try:
+            sockets = list(self.open_sockets)
+        finally:
+            self.lock.release()
+        for open_socket in sockets:
+            try:
+                open_socket.shutdown(socket.SHUT_RDWR)
+            except (socket.error):
+                pass
+        end = time.time() + 2
+        while self.open_sockets and time.time() < end:
+            time.sleep(0.01)
+
+    # The synthetic channel
+
+    def get_repository_url(self, repo):
+        return 'http://repositories%d.test/repository-%04d.json' % (
+            repo % self.hosts, repo)
+
+    def get_repository_urls(self):
+        return [self.get_repository_url(repo) for repo in
+            range(self.repositories)]
+
+    def get_package_names(self):
+        return sorted(self.packages.keys())
+
+    def get_version(self, name):
+        return '1.0.%d' % self.packages[name][1]
+
+    def get_versions(self):
+        versions = {}
+        for name, (repo, version) in self.packages.items():
+            versions[name] = version
+        return versions
+
+    def get_package_path(self, name, version):
+        return '/packages/%s-%s.zip' % (name, version)
+
+    def get_package_url(self, name, version=None):
+        if version == None:
+            version = self.get_version(name)
+        return 'http://packages%d.test%s' % (self.packages[name][0] %
+            self.hosts, self.get_package_path(name, version))
+
+    def bump(self, names):
+        # Releases a new version of each of the packages
+        self.lock.acquire()
+        try:
+            for name in names:
+                self.packages[name][1] += 1
+            self.revision += 1
+            self.history[self.revision] = self.get_versions()
+            self.content_cache.clear()
+        finally:
+            self.lock.release()
+
+    def get_package_info(self, name):
+        version = self.get_version(name)
+        download = {'version': version, 'url': self.get_package_url(name)}
+        if self.sha256:
+            download['sha256'] = hashlib.sha256(self.get_zip(name,
+                version)).hexdigest()
+        if self.mirrors:
+            download['mirrors'] = ['http://%s%s' % (host,
+                self.get_package_path(name, version)) for host in
+                self.mirrors]
+        return {
+            'name': name,
+            'description': 'Synthetic package %s' % name,
+            'author': 'benchmark',
+            'homepage': 'http://example.test/' + name,
+            'last_modified': '2013-01-01 00:00:00',
+            'platforms': {'*': [download]}
+        }
+
+    def get_channel(self, since=None):
+        channel = {'schema_version': '1.2'}
+        if self.sync:
+            channel['sync_token'] = str(self.revision)
+
+        # A token from an earlier revision gets only the packages that
+        # changed since then
+        if since and since.isdigit() and int(since) in self.history:
+            old_versions = self.history[int(since)]
+            changed = {}
+            for name, (repo, version) in sorted(self.packages.items()):
+                if repo >= self.embedded_repositories or \
+                        old_versions.get(name) == version:
+                    continue
+                changed.setdefault(self.get_repository_url(repo),
+                    []).append(self.get_package_info(name))
+            channel['delta'] = True
+            channel['packages'] = changed
+            return channel
+
+        channel['repositories'] = self.get_repository_urls()
+        channel['package_name_map'] = {}
+        channel['renamed_packages'] = {}
+        channel['packages'] = {}
+        for repo in range(self.embedded_repositories):
+            channel['packages'][self.get_repository_url(repo)] = [
+                self.get_package_info(name) for name in
+                self.repository_packages[repo]]
+        return channel
+
+    def get_repository(self, repo):
+        return {
+            'schema_version': '1.2',
+            'packages': [self.get_package_info(name) for name in
+                self.repository_packages[repo]]
+        }
+
+    def get_zip(self, name, version):
+        key = (name, version)
+        if key in self.zip_cache:
+            return self.zip_cache[key]
+
+        output = StringIO.StringIO()
+        package_zip = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        prefix = '%s-%s/' % (name, version)
+        package_zip.writestr(prefix, '')
+        for i in range(self.files_per_package):
+            # Only the first file changes between versions
+            line = '%s file %d %s\n' % (name, i, version if i == 0 else '')
+            content = line * (self.file_size / len(line) + 1)
+            package_zip.writestr(prefix + 'file%d.txt' % i,
+                content[:self.file_size])
+        package_zip.close()
+
+        self.zip_cache[key] = output.getvalue()
+        return self.zip_cache[key]
+
+    def get_content(self, host, path, query):
+        # Returns the body and content type for a url, or None if it
+        # doesn't exist
+        key = (host, path, query.get('since', [None])[0])
+        self.lock.acquire()
+        try:
+            if key in self.content_cache:
+                return self.content_cache[key]
+        finally:
+            self.lock.release()
+
+        content = None
+        if host == 'channel.test' and path == '/repositories.json':
+            content = (json.dumps(self.get_channel(key[2])),
+                'application/json')
+        elif host.startswith('repositories') and \
+                path.startswith('/repository-'):
+            repo = path[len('/repository-'):-len('.json')]
+            if repo.isdigit() and int(repo) < self.repositories and \
+                    host == self.get_repository_url(int(repo)).split('/')[2]:
+                content = (json.dumps(self.get_repository(int(repo))),
+                    'application/json')
+        elif path.startswith('/packages/') and path.endswith('.zip'):
+            name, version = path[len('/packages/'):-len('.zip')].split('-',
+                1)
+            if name in self.packages:
+                content = (self.get_zip(name, version), 'application/zip')
+        elif path == '/submit':
+            content = (json.dumps({'result': 'success'}), 'application/json')
+
+        self.lock.acquire()
+        try:
+            self.content_cache[key] = content
+        finally:
+            self.lock.release()
+        return content
+
+    # Serving requests
+
+    def check_rate_limit(self, host, options):
+        # Returns the rate limit headers to send, and if the request is over
+        # the limit
+        if not options['rate_limit']:
+            return [], False
+        self.lock.acquire()
+        try:
+            now = time.time()
+            window_start, count = self.rate_limits.get(host, (now, 0))
+            if now >= window_start + options['rate_limit_window']:
+                window_start, count = now, 0
+            count += 1
+            self.rate_limits[host] = (window_start, count)
+        finally:
+            self.lock.release()
+
+        reset = window_start + options['rate_limit_window']
+        remaining = max(0, options['rate_limit'] - count)
+        headers = [('X-RateLimit-Limit', str(options['rate_limit'])),
+            ('X-RateLimit-Remaining', str(remaining)),
+            ('X-RateLimit-Reset', str(int(math.ceil(reset))))]
+        limited = count > options['rate_limit']
+        if limited and options['rate_limit_style'] != 'reset':
+            headers.append(('Retry-After',
+                str(int(math.ceil(reset - now)))))
+        return headers, limited
+
+    def handle(self, handler):
+        start = time.time()
+        url = urlparse.urlsplit(handler.path)
+        host = (url.netloc or handler.headers.get('host', '')).split(':')[0]
+        host = host.lower()
+        query = urlparse.parse_qs(url.query)
+        options = self.get_host_options(host)
+
+        self.begin_request(host)
+        try:
+            if options['latency']:
+                time.sleep(options['latency'])
+            status, headers, body, sent = self.respond(handler, host,
+                url.path, query, options)
+        finally:
+            self.end_request(host)
+
+        self.record({
+            'host': host,
+            'path': url.path + (url.query and '?' + url.query or ''),
+            'method': handler.command,
+            'status': status,
+            'bytes': sent,
+            'encoding': dict(headers).get('Content-Encoding'),
+            'retry_after': dict(headers).get('Retry-After'),
+            'range': handler.headers.get('range'),
+            'conditional': bool(handler.headers.get('if-none-match') or
+                handler.headers.get('if-modified-since')),
+            'start': start,
+            'seconds': time.time() - start
+        })
+
+    def respond(self, handler, host, path, query, options):
+        headers, limited = self.check_rate_limit(host, options)
+        if limited:
+            status = 429
+            if options['rate_limit_style'] == 'reset':
+                status = 403
+            return self.send(handler, status, headers, 'Rate limited')
+
+        content = self.get_content(host, path, query)
+        if content == None:
+            return self.send(handler, 404, headers, 'Not found')
+        body, content_type = content
+        headers.append(('Content-Type', content_type))
+
+        etag = None
+        if self.etags:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()[0:16]
+
+        if content_type == 'application/zip':
+            headers.append(('Accept-Ranges', 'bytes'))
+        elif self.gzip and 'gzip' in handler.headers.get('accept-encoding',
+                ''):
+            body = self.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Vary', 'Accept-Encoding'))
+            if etag:
+                etag = etag[:-1] + '-gzip"'
+
+        if etag:
+            headers.append(('ETag', etag))
+            if handler.headers.get('if-none-match') == etag:
+                return self.send(handler, 304, headers, None)
+
+        # Only the rest of a package file is sent if it hasn't changed
+        byte_range = handler.headers.get('range', '')
+        if_range = handler.headers.get('if-range')
+        if content_type == 'application/zip' and \
+                byte_range.startswith('bytes=') and \
+                byte_range.endswith('-') and (not if_range or
+                if_range == etag):
+            offset = byte_range[len('bytes='):-1]
+            if offset.isdigit() and int(offset) < len(body):
+                headers.append(('Content-Range', 'bytes %s-%d/%d' % (offset,
+                    len(body) - 1, len(body))))
+                return self.send(handler, 206, headers, body[int(offset):])
+
+        drop_after = 0
+        if content_type == 'application/zip':
+            drop_after = options['drop_after']
+        return self.send(handler, 200, headers, body, drop_after)
+
+    def compress(self, body):
+        key = ('gzip', hashlib.sha1(body).hexdigest())
+        if key not in self.content_cache:
+            output = StringIO.StringIO()
+            gzip_file = gzip.GzipFile(fileobj=output, mode='wb', mtime=0)
+            gzip_file.write(body)
+            gzip_file.close()
+            self.content_cache[key] = output.getvalue()
+        return self.content_cache[key]
+
+    def send(self, handler, status, headers, body, drop_after=0):
+        # Returns the status, headers, body and the number of body bytes
+        # that were actually sent
+        handler.send_response(status)
+        for name, value in headers:
+            handler.send_header(name, value)
+        if body != None:
+            handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        sent = 0
+        if body != None:
+            # A dropped connection sends part of the body and then closes,
+            # as a flaky network would
+            if drop_after and drop_after < len(body):
+                handler.wfile.write(body[:drop_after])
+                handler.close_connection = 1
+                sent = drop_after
+                self.count('dropped')
+            else:
+                handler.wfile.write(body)
+                sent = len(body)
+        return status, headers, body, sent
+
+    # Statistics
+
+    def reset_stats(self):
+        self.lock.acquire()
+        try:
+            self.log = []
+            self.counters = {}
+            self.active = {}
+            self.max_active = {}
+            self.connections = 0
+        finally:
+            self.lock.release()
+
+    def open_connection(self, open_socket):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+            self.open_sockets.add(open_socket)
+        finally:
+            self.lock.release()
+
+    def close_connection(self, open_socket):
+        self.lock.acquire()
+        try:
+            self.open_sockets.discard(open_socket)
+        finally:
+            self.lock.release()
+
+    def count(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        finally:
+            self.lock.release()
+
+    def begin_request(self, host):
+        self.lock.acquire()
+        try:
+            for key in [host, '*']:
+                self.active[key] = self.active.get(key, 0) + 1
+                self.max_active[key] = max(self.max_active.get(key, 0),
+                    self.active[key])
+        finally:
+            self.lock.release()
+
+    def end_request(self, host):
+        self.lock.acquire()
+        try:
+            for key in [host, '*']:
+                self.active[key] -= 1
+        finally:
+            self.lock.release()
+
+    def wait_for_idle(self, timeout):
+        # Waits for the requests being handled to finish
+        end = time.time() + timeout
+        while self.active.get('*') and time.time() < end:
+            time.sleep(0.01)
+        # Connections are closed just after the last response is written
+        time.sleep(0.1)
+
+    def get_open_connections(self):
+        self.lock.acquire()
+        try:
+            return len(self.open_sockets)
+        finally:
+            self.lock.release()
+
+    def record(self, entry):
+        self.lock.acquire()
+        try:
+            self.log.append(entry)
+        finally:
+            self.lock.release()
+
+    def get_requests(self, host=None, path=None, status=None):
+        # The logged requests, optionally only those to a host, for paths
+        # starting with path, or with a status
+        self.lock.acquire()
+        try:
+            return [entry for entry in self.log if
+                (host == None or entry['host'] == host) and
+                (path == None or entry['path'].startswith(path)) and
+                (status == None or entry['status'] == status)]
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            statuses = {}
+            for entry in self.log:
+                status = str(entry['status'])
+                statuses[status] = statuses.get(status, 0) + 1
+            max_active = dict(self.max_active)
+            return {
+                'requests': len(self.log),
+                'bytes': sum([entry['bytes'] for entry in self.log]),
+                'connections': self.connections,
+                'statuses': statuses,
+                'max_concurrency': max_active.pop('*', 0),
+                'max_concurrency_per_host': max_active,
+                'counters': dict(self.counters)
+            }
+        finally:
+            self.lock.release()
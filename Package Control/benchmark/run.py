@@ -0,0 +1,299 @@
+# Runs the Package Control benchmark scenarios against a local fixture
+# server and prints the results as JSON. Each scenario runs in a process
+# of its own, with a fresh data folder, so its memory use and the state of
+# the module level caches don't depend on the scenarios run before it.
+#
+#   python run.py                      runs every scenario
+#   python run.py --list               lists the scenarios
+#   python run.py -o results.json list_available_packages install_package
+#
+# The exit code is 1 if a scenario fails or any of its checks don't pass.
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import tempfile
+import datetime
+import subprocess
+import optparse
+import traceback
+
+try:
+    import resource
+except (ImportError):
+    resource = None
+
+benchmark_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmark_path)
+# Loading Package Control must not leave a .pyc in the package
+sys.dont_write_bytecode = True
+
+import sublime
+import fixture
+import scenarios
+
+
+def get_max_rss():
+    # Returns the peak resident memory of this process in kilobytes
+    if not resource:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == 'darwin':
+        max_rss /= 1024
+    return max_rss
+
+
+def get_cpu_time():
+    # The user and system time used by every thread of this process,
+    # including the fixture server
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Bench():
+    # Holds the loaded Package Control module and the fixture server for a
+    # scenario, along with helpers to reset the state between iterations
+    def __init__(self, scenario, data_path):
+        self.scenario = scenario
+        self.data_path = data_path
+        sublime.data_path = data_path
+        for folder in ['Packages/User', 'Installed Packages',
+                'Pristine Packages']:
+            os.makedirs(os.path.join(data_path, folder))
+
+        # The startup work queued when the module is loaded isn't run
+        sublime.timeouts_enabled = False
+        self.pc = imp.load_source('Package Control', os.path.join(
+            sublime.package_path, 'Package Control.py'))
+        sublime.timeouts_enabled = True
+
+        self.fixture = fixture.Fixture(**scenario.fixture)
+        self.fixture.start()
+        self.configure()
+
+    def configure(self):
+        sublime.reset_settings()
+        settings = self.get_settings()
+        settings.set('repository_channels', [self.fixture.channel_url])
+        settings.set('repositories', [])
+        settings.set('http_proxy', self.fixture.proxy)
+        settings.set('https_proxy', '')
+        settings.set('submit_url', self.fixture.submit_url)
+        settings.set('submit_usage', False)
+        settings.set('timeout', 10)
+        settings.set('installed_packages', [])
+        for name, value in self.scenario.settings.items():
+            settings.set(name, value)
+
+    def get_settings(self):
+        return sublime.load_settings('Package Control.sublime-settings')
+
+    def manager(self):
+        return self.pc.PackageManager()
+
+    def reset_state(self, disk=True):
+        # Forgets everything Package Control has cached, in memory and, if
+        # disk is True, on disk, so the next iteration starts cold
+        pc = self.pc
+        for connections in pc._connection_pool.idle.values():
+            for connection in connections:
+                connection.close()
+        pc._connection_pool = pc.HttpConnectionPool()
+        pc._channel_repository_cache = pc.ExpiringCache(5000)
+        pc._rate_limiter = pc.RateLimiter()
+        pc._host_latencies = pc.HostLatencies()
+        pc._transfer_stats = pc.TransferStats()
+        pc._package_catalog.clear()
+        pc._metadata_index.clear()
+        if disk:
+            shutil.rmtree(os.path.join(self.data_path,
+                'Package Control Cache'), True)
+
+    def remove_packages(self):
+        # Removes every installed package, along with the archive, backups
+        # and pristine copies, so they have to be downloaded again
+        packages_path = sublime.packages_path()
+        for name in os.listdir(packages_path):
+            if name != 'User':
+                shutil.rmtree(os.path.join(packages_path, name), True)
+        for folder in ['Installed Packages', 'Pristine Packages', 'Backup',
+                'Package Archives']:
+            shutil.rmtree(os.path.join(self.data_path, folder), True)
+        for folder in ['Installed Packages', 'Pristine Packages']:
+            os.makedirs(os.path.join(self.data_path, folder))
+        self.get_settings().set('installed_packages', [])
+        self.pc._metadata_index.clear()
+
+    def install_packages(self, names):
+        # Installs the packages, untimed, returning the ones installed
+        transaction = self.pc.PackageTransaction(self.manager())
+        for name in names:
+            transaction.add(name)
+        installed = transaction.run(4)
+        self.get_settings().set('installed_packages', list(installed))
+        return installed
+
+    def get_installed_version(self, name):
+        return self.manager().get_metadata(name).get('version')
+
+    def stop(self):
+        self.fixture.stop()
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    middle = len(values) / 2
+    median = values[middle]
+    if len(values) % 2 == 0:
+        median = (values[middle - 1] + values[middle]) / 2.0
+    return {'min': round(values[0], 4), 'median': round(median, 4),
+        'max': round(values[-1], 4)}
+
+
+def run_scenario(scenario, iterations):
+    # Runs a scenario in this process and returns its results
+    data_path = tempfile.mkdtemp(prefix='pc-benchmark-')
+    result = {'name': scenario.name, 'description': scenario.description}
+    bench = None
+    try:
+        bench = Bench(scenario, data_path)
+        result['memory'] = {'baseline_rss_kb': get_max_rss()}
+        scenario.prepare(bench)
+
+        results = []
+        for i in range(iterations or scenario.iterations):
+            scenario.reset(bench)
+            del sublime.errors[:]
+            bench.fixture.reset_stats()
+            start = time.time()
+            start_cpu = get_cpu_time()
+            metrics = scenario.run(bench) or {}
+            seconds = time.time() - start
+            iteration = bench.fixture.get_stats()
+            iteration['seconds'] = round(seconds, 4)
+            iteration['cpu_seconds'] = round(get_cpu_time() - start_cpu, 4)
+            iteration['error_messages'] = list(sublime.errors)
+            iteration.update(metrics)
+            iteration.update(scenario.inspect(bench) or {})
+            results.append(iteration)
+
+        result['iterations'] = results
+        result['seconds'] = summarize([iteration['seconds'] for iteration in
+            results])
+        result['memory']['max_rss_kb'] = get_max_rss()
+        checks = scenario.check(bench, results)
+        checks['no error messages'] = not [iteration for iteration in
+            results if iteration['error_messages']]
+        result['checks'] = checks
+        result['passed'] = not [name for name, passed in checks.items() if
+            not passed]
+    except (Exception):
+        result['error'] = traceback.format_exc()
+        result['passed'] = False
+    finally:
+        if bench:
+            bench.stop()
+        shutil.rmtree(data_path, True)
+    return result
+
+
+def run_child(scenario, options):
+    # Runs a scenario in a new process, returning its results
+    result_fd, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(result_fd)
+    log_fd, log_path = tempfile.mkstemp(suffix='.log')
+    try:
+        args = [sys.executable, os.path.abspath(__file__), '--child',
+            scenario.name, '--result', result_path]
+        if options.iterations:
+            args.extend(['--iterations', str(options.iterations)])
+        # The console output of Package Control goes to stderr, or to a log
+        # that is shown if the scenario fails
+        if options.verbose:
+            os.close(log_fd)
+            output = sys.stderr
+        else:
+            output = os.fdopen(log_fd, 'wb')
+        returncode = subprocess.call(args, stdout=output,
+            stderr=subprocess.STDOUT)
+        if not options.verbose:
+            output.close()
+        try:
+            with open(result_path, 'rb') as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            result = {'name': scenario.name, 'passed': False,
+                'error': 'The scenario exited with code %s' % returncode}
+        if not result.get('passed') and not options.verbose:
+            with open(log_path, 'rb') as f:
+                result['log'] = f.read()[-10000:]
+        return result
+    finally:
+        for path in [result_path, log_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-l', '--list', action='store_true',
+        help='list the scenarios and exit')
+    parser.add_option('-n', '--iterations', type='int',
+        help='the number of timed runs of each scenario')
+    parser.add_option('-o', '--output', help='write the JSON results to a file')
+    parser.add_option('-v', '--verbose', action='store_true',
+        help='show the console output of Package Control')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--result', help=optparse.SUPPRESS_HELP)
+    options, names = parser.parse_args()
+
+    available = dict([(scenario.name, scenario) for scenario in
+        scenarios.scenarios])
+
+    if options.list:
+        for scenario in scenarios.scenarios:
+            print '%-32s %s' % (scenario.name, scenario.description)
+        return 0
+
+    if options.child:
+        result = run_scenario(available[options.child], options.iterations)
+        with open(options.result, 'wb') as f:
+            json.dump(result, f)
+        return 0
+
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        parser.error('Unknown scenario %s' % ', '.join(unknown))
+    selected = [available[name] for name in names] or scenarios.scenarios
+
+    results = []
+    for scenario in selected:
+        print >> sys.stderr, 'Running %s' % scenario.name
+        results.append(run_child(scenario, options))
+
+    output = json.dumps({
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'scenarios': results
+    }, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+    failed = [result['name'] for result in results if not result['passed']]
+    if failed:
+        print >> sys.stderr, 'Failed: %s' % ', '.join(failed)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
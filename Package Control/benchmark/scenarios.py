@@ -0,0 +1,645 @@
+# The benchmark scenarios. Each one configures the fixture server and the
+# Package Control settings, and times run() over a number of iterations.
+# check() returns a dict of named pass/fail results, which is how a
+# scenario shows that the behaviour it measures is actually happening.
+import os
+import json
+import time
+import threading
+
+
+class Scenario():
+    # The name used to pick the scenario on the command line
+    name = None
+    description = ''
+    # Keyword arguments for fixture.Fixture()
+    fixture = {}
+    # Package Control settings used on top of the defaults
+    settings = {}
+    iterations = 3
+
+    def prepare(self, bench):
+        # Called once, untimed, before the first iteration
+        pass
+
+    def reset(self, bench):
+        # Called, untimed, before each iteration
+        bench.reset_state()
+
+    def run(self, bench):
+        # The timed part, which returns a dict of extra values to report
+        return {}
+
+    def inspect(self, bench):
+        # Called, untimed, after each iteration to return more values to
+        # report, such as from work that outlives run()
+        return {}
+
+    def check(self, bench, results):
+        return {}
+
+
+def get_package_count(bench):
+    return bench.fixture.repositories * bench.fixture.packages_per_repository
+
+
+def all_equal(results, name, value):
+    return not [result for result in results if result[name] != value]
+
+
+class ListRepositories(Scenario):
+    name = 'list_repositories'
+    description = 'Download the channel and list its repositories'
+
+    def run(self, bench):
+        return {'repositories': len(bench.manager().list_repositories())}
+
+    def check(self, bench, results):
+        return {
+            'every repository listed': all_equal(results, 'repositories',
+                bench.fixture.repositories),
+            'one request for the channel': all_equal(results, 'requests', 1)
+        }
+
+
+class ListAvailablePackages(Scenario):
+    name = 'list_available_packages'
+    description = 'Refresh the list of packages from a cold cache, with ' + \
+        'half of the repositories not included in the channel'
+    fixture = {'embedded_repositories': 50}
+
+    def run(self, bench):
+        return {'packages': len(bench.manager().list_available_packages())}
+
+    def check(self, bench, results):
+        downloaded = bench.fixture.repositories - \
+            bench.fixture.embedded_repositories
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'channel and missing repositories requested once':
+                all_equal(results, 'requests', downloaded + 1)
+        }
+
+
+class MakePackageList(Scenario):
+    name = 'make_package_list'
+    description = 'Build the Install Package list from a cold cache ' + \
+        'with 20 packages installed'
+
+    def prepare(self, bench):
+        self.installed = bench.install_packages(
+            bench.fixture.get_package_names()[0:20])
+
+    def run(self, bench):
+        package_list = bench.pc.PackageInstaller().make_package_list()
+        reinstalls = [entry for entry in package_list if
+            entry[2].startswith('reinstall')]
+        return {'entries': len(package_list), 'reinstalls': len(reinstalls)}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'entries',
+                get_package_count(bench)),
+            'installed packages offered as reinstalls': all_equal(results,
+                'reinstalls', len(self.installed))
+        }
+
+
+class InstallPackage(Scenario):
+    name = 'install_package'
+    description = 'Download and install 20 packages, one after another'
+    fixture = {'files_per_package': 20, 'file_size': 4096}
+
+    def prepare(self, bench):
+        self.names = bench.fixture.get_package_names()[0:20]
+        self.packages = bench.manager().list_available_packages()
+
+    def reset(self, bench):
+        bench.remove_packages()
+
+    def run(self, bench):
+        manager = bench.manager()
+        installed = [name for name in self.names if
+            manager.install_package(name, packages=self.packages)]
+        return {'installed': len(installed)}
+
+    def check(self, bench, results):
+        return {
+            'every package installed': all_equal(results, 'installed',
+                len(self.names)),
+            'one request per package file': all_equal(results, 'requests',
+                len(self.names)),
+            'installed versions match': not [name for name in self.names if
+                bench.get_installed_version(name) !=
+                bench.fixture.get_version(name)]
+        }
+
+
+class AutomaticUpgrader(Scenario):
+    name = 'automatic_upgrader'
+    description = 'Run the startup upgrade of 20 installed packages that ' + \
+        'each have a new version'
+    settings = {'auto_upgrade': True, 'auto_upgrade_frequency': 0}
+
+    def prepare(self, bench):
+        self.names = bench.fixture.get_package_names()[0:20]
+
+    def reset(self, bench):
+        bench.remove_packages()
+        bench.reset_state()
+        bench.install_packages(self.names)
+        bench.fixture.bump(self.names)
+        bench.get_settings().set('auto_upgrade_last_run', None)
+        bench.reset_state()
+
+    def run(self, bench):
+        bench.pc.AutomaticUpgrader(self.names).run()
+        upgraded = [name for name in self.names if
+            bench.get_installed_version(name) ==
+            bench.fixture.get_version(name)]
+        return {'upgraded': len(upgraded)}
+
+    def check(self, bench, results):
+        return {
+            'every package upgraded': all_equal(results, 'upgraded',
+                len(self.names))
+        }
+
+
+class RepositoryScheduler(Scenario):
+    name = 'repository_scheduler'
+    description = 'Download 64 repositories from 8 hosts that each take ' + \
+        '100ms to respond, two at a time per host'
+    fixture = {'repositories': 64, 'embedded_repositories': 0,
+        'host_options': dict([('repositories%d.test' % i, {'latency': 0.1})
+            for i in range(8)])}
+    settings = {'repository_download_workers': 8,
+        'repository_download_domain_limit': 2,
+        'repository_download_domain_delay': 0}
+
+    def run(self, bench):
+        return {'packages': len(bench.manager().list_available_packages())}
+
+    def check(self, bench, results):
+        serial_seconds = bench.fixture.repositories * 0.1
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'each repository requested once': all_equal(results,
+                'requests', bench.fixture.repositories + 1),
+            'downloads run in parallel': not [result for result in results
+                if result['max_concurrency'] < 2],
+            'no more than repository_download_workers at once': not [
+                result for result in results if result['max_concurrency'] >
+                8],
+            'no more than repository_download_domain_limit per host': not [
+                result for result in results if [count for count in
+                result['max_concurrency_per_host'].values() if count > 2]],
+            'faster than downloading one at a time': not [result for result
+                in results if result['seconds'] > serial_seconds / 2]
+        }
+
+
+class CacheRevalidation(Scenario):
+    name = 'cache_revalidation'
+    description = 'Refresh the list of packages after a restart, with ' + \
+        'the channel and repositories unchanged since they were cached'
+    fixture = {'embedded_repositories': 50}
+
+    def prepare(self, bench):
+        bench.manager().list_available_packages()
+
+    def reset(self, bench):
+        # Only the in-memory caches are lost, as with a restart
+        bench.reset_state(disk=False)
+
+    def run(self, bench):
+        return {'packages': len(bench.manager().list_available_packages())}
+
+    def check(self, bench, results):
+        requests = bench.fixture.repositories - \
+            bench.fixture.embedded_repositories + 1
+        cache_path = os.path.join(bench.data_path, 'Package Control Cache')
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'every request answered with a 304': all_equal(results,
+                'statuses', {'304': requests}),
+            'no content downloaded': all_equal(results, 'bytes', 0),
+            'cache kept outside of the User folder': os.path.isdir(
+                cache_path) and not [name for name in os.listdir(os.path.join(
+                bench.data_path, 'Packages', 'User')) if
+                name.endswith('.cache')]
+        }
+
+
+class ConnectionReuse(Scenario):
+    name = 'connection_reuse'
+    description = 'Download 40 repositories from one host with 4 ' + \
+        'workers, reusing kept-alive connections'
+    fixture = {'repositories': 40, 'embedded_repositories': 0, 'hosts': 1}
+    settings = {'repository_download_workers': 4,
+        'repository_download_domain_limit': 4,
+        'repository_download_domain_delay': 0}
+
+    def run(self, bench):
+        packages = bench.manager().list_available_packages()
+        pool = bench.pc._connection_pool
+        return {'packages': len(packages), 'pool_created': pool.created,
+            'pool_reused': pool.reused}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            # One connection per worker, plus the one for the channel
+            'no more connections than workers': not [result for result in
+                results if result['connections'] > 5],
+            'the rest of the requests reuse pooled connections': not [result for
+                result in results if result['pool_reused'] !=
+                result['requests'] - result['pool_created']]
+        }
+
+
+def get_early_requests(requests):
+    # Returns the requests that started while the host had told us to wait
+    # because of an earlier rate limited response
+    early = []
+    for limited in requests:
+        if not limited['retry_after']:
+            continue
+        end = limited['start'] + limited['seconds']
+        retry_time = end + int(limited['retry_after'])
+        early.extend([request for request in requests if
+            end + 0.05 < request['start'] < retry_time - 0.05])
+    return early
+
+
+def get_max_rate(requests, window):
+    # The most requests started within any window of seconds
+    starts = sorted([request['start'] for request in requests])
+    most = 0
+    for i in range(len(starts)):
+        most = max(most, len([start for start in starts[i:] if
+            start < starts[i] + window]))
+    return most
+
+
+class RateLimitRetryAfter(Scenario):
+    name = 'rate_limit_retry_after'
+    description = 'Download 30 repositories from a host that allows 10 ' + \
+        'requests a second and answers the rest with a 429 and Retry-After'
+    fixture = {'repositories': 30, 'embedded_repositories': 0, 'hosts': 1,
+        'host_options': {'repositories0.test': {'rate_limit': 10,
+        'rate_limit_window': 1}}}
+    settings = {'repository_download_workers': 4,
+        'repository_download_domain_limit': 4,
+        'repository_download_domain_delay': 0}
+
+    def run(self, bench):
+        packages = bench.manager().list_available_packages()
+        requests = bench.fixture.get_requests('repositories0.test')
+        return {'packages': len(packages),
+            'early_requests': len(get_early_requests(requests))}
+
+    def check(self, bench, results):
+        return {
+            'every package listed after retrying': all_equal(results,
+                'packages', get_package_count(bench)),
+            'the host rate limited requests': not [result for result in
+                results if not result['statuses'].get('429')],
+            'no requests before Retry-After passed': all_equal(results,
+                'early_requests', 0)
+        }
+
+
+class RateLimitPacing(Scenario):
+    name = 'rate_limit_pacing'
+    description = 'Download 40 repositories from a host listed in ' + \
+        'rate_limited_hosts, paced to 20 requests a second with a burst of 5'
+    fixture = {'repositories': 40, 'embedded_repositories': 0, 'hosts': 1}
+    settings = {'repository_download_workers': 4,
+        'repository_download_domain_limit': 4,
+        'repository_download_domain_delay': 0,
+        'rate_limited_hosts': ['repositories0.test'],
+        'rate_limit_requests_per_second': 20, 'rate_limit_burst': 5}
+
+    def run(self, bench):
+        packages = bench.manager().list_available_packages()
+        requests = bench.fixture.get_requests('repositories0.test')
+        return {'packages': len(packages),
+            'most_requests_in_a_second': get_max_rate(requests, 1)}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'no more than the rate plus the burst in any second': not [
+                result for result in results if
+                result['most_requests_in_a_second'] > 25],
+            'requests spread over the time the rate needs': not [result for
+                result in results if result['seconds'] < (40 - 5) / 20.0]
+        }
+
+
+class RateLimitFailFast(Scenario):
+    name = 'rate_limit_fail_fast'
+    description = 'Download 30 repositories from a host that allows 5 ' + \
+        'requests an hour, giving up rather than waiting for the reset'
+    fixture = {'repositories': 30, 'embedded_repositories': 0, 'hosts': 1,
+        'host_options': {'repositories0.test': {'rate_limit': 5,
+        'rate_limit_window': 3600, 'rate_limit_style': 'reset'}}}
+    settings = {'repository_download_workers': 4,
+        'repository_download_domain_limit': 4,
+        'repository_download_domain_delay': 0, 'rate_limit_max_wait': 60}
+
+    def reset(self, bench):
+        bench.reset_state()
+        bench.fixture.rate_limits.clear()
+
+    def run(self, bench):
+        manager = bench.manager()
+        packages = manager.list_available_packages()
+        limited = bench.fixture.get_requests('repositories0.test',
+            status=403)
+        late = []
+        if limited:
+            end = min([request['start'] + request['seconds'] for request in
+                limited])
+            late = [request for request in bench.fixture.get_requests(
+                'repositories0.test') if request['start'] > end + 0.05]
+        return {'packages': len(packages),
+            'failed_repositories': len(manager.failed_repositories),
+            'requests_after_block': len(late)}
+
+    def check(self, bench, results):
+        return {
+            'allowed repositories listed': all_equal(results, 'packages',
+                5 * bench.fixture.packages_per_repository),
+            'the rest failed': all_equal(results, 'failed_repositories',
+                bench.fixture.repositories - 5),
+            'no requests once the host blocked us': all_equal(results,
+                'requests_after_block', 0),
+            'gave up without waiting': not [result for result in results if
+                result['seconds'] > 5]
+        }
+
+
+class CoalescedRefresh(Scenario):
+    name = 'coalesced_refresh'
+    description = 'Refresh the list of packages from 8 threads at once, ' + \
+        'with 20 repositories that each take 200ms to download'
+    fixture = {'repositories': 20, 'embedded_repositories': 0, 'hosts': 4,
+        'host_options': dict([('repositories%d.test' % i, {'latency': 0.2})
+            for i in range(4)] + [('channel.test', {'latency': 0.2})])}
+    settings = {'repository_download_domain_delay': 0}
+
+    def run(self, bench):
+        counts = []
+
+        def refresh():
+            counts.append(len(bench.manager().list_available_packages()))
+
+        threads = [threading.Thread(target=refresh) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {'package_counts': counts,
+            'coalesced': bench.pc._channel_repository_cache.coalesced}
+
+    def check(self, bench, results):
+        return {
+            'every thread listed every package': all_equal(results,
+                'package_counts', [get_package_count(bench)] * 8),
+            'channel and each repository requested once': all_equal(
+                results, 'requests', bench.fixture.repositories + 1),
+            'threads waited on in-flight downloads': not [result for result
+                in results if not result['coalesced']]
+        }
+
+
+class CoalescedRefreshUncached(CoalescedRefresh):
+    name = 'coalesced_refresh_uncached'
+    description = 'The same as coalesced_refresh with a cache_length of ' + \
+        '0, so threads only get results handed over from in-flight downloads'
+    settings = {'repository_download_domain_delay': 0, 'cache_length': 0}
+
+    def check(self, bench, results):
+        # Threads that start after a download finished fetch it again, so
+        # only the results are checked
+        return {
+            'every thread listed every package': all_equal(results,
+                'package_counts', [get_package_count(bench)] * 8),
+            'threads waited on in-flight downloads': not [result for result
+                in results if not result['coalesced']]
+        }
+
+
+class DeltaSync(Scenario):
+    name = 'delta_sync'
+    description = 'Refresh a channel that supports sync tokens after 5 ' + \
+        'of its 3000 packages have new versions'
+    fixture = {'sync': True}
+
+    def prepare(self, bench):
+        bench.manager().list_available_packages()
+        self.full_bytes = bench.fixture.get_stats()['bytes']
+        self.round = 0
+
+    def reset(self, bench):
+        # Only the in-memory caches are lost, as with a restart
+        bench.reset_state(disk=False)
+        names = bench.fixture.get_package_names()
+        self.round += 1
+        self.bumped = [names[self.round * 500 + i * 31] for i in range(5)]
+        bench.fixture.bump(self.bumped)
+
+    def run(self, bench):
+        packages = bench.manager().list_available_packages()
+        stale = [name for name in self.bumped if
+            packages[name]['downloads'][0]['version'] !=
+            bench.fixture.get_version(name)]
+        channel_requests = bench.fixture.get_requests('channel.test')
+        sync_state = bench.pc.DiskCache().get(bench.fixture.channel_url +
+            '.sync') or ''
+        return {'packages': len(packages), 'stale_packages': len(stale),
+            'delta_requests': len([request for request in channel_requests if
+                '?since=' in request['path']]),
+            'full_channel_bytes': self.full_bytes,
+            'sync_state_bytes': len(sync_state),
+            'channel_json_bytes': len(json.dumps(bench.fixture.get_channel()))}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'new versions picked up': all_equal(results, 'stale_packages',
+                0),
+            'only the changes requested': not [result for result in results
+                if result['requests'] != 1 or result['delta_requests'] != 1],
+            'a fraction of the full channel downloaded': not [result for
+                result in results if result['bytes'] >
+                result['full_channel_bytes'] / 20],
+            # The full channel is already in the download cache, so only
+            # the token and the changes since are saved
+            'sync state is a fraction of the channel': not [result for
+                result in results if result['sync_state_bytes'] >
+                result['channel_json_bytes'] / 20]
+        }
+
+
+class DeltaSyncWithoutEtags(DeltaSync):
+    name = 'delta_sync_without_etags'
+    description = 'The same as delta_sync with a server that sends no ' + \
+        'ETags, so the full channel is not in the download cache'
+    fixture = {'sync': True, 'etags': False}
+
+
+class HedgedDownloads(Scenario):
+    name = 'hedged_downloads'
+    description = 'Install 8 packages whose host takes 1s to respond, ' + \
+        'with a mirror that responds at once and a 200ms hedge delay'
+    fixture = {'mirrors': ['mirror0.test'],
+        'host_options': {'packages0.test': {'latency': 1}}}
+    settings = {'download_hedge_delay': 200}
+
+    def prepare(self, bench):
+        self.names = bench.fixture.get_package_names()[0:8]
+        self.packages = bench.manager().list_available_packages()
+
+    def reset(self, bench):
+        bench.remove_packages()
+        bench.pc._host_latencies = bench.pc.HostLatencies()
+
+    def run(self, bench):
+        manager = bench.manager()
+        durations = []
+        for name in self.names:
+            start = time.time()
+            if manager.install_package(name, packages=self.packages):
+                durations.append(round(time.time() - start, 4))
+        return {'install_seconds': durations}
+
+    def inspect(self, bench):
+        # Once the slow responses have arrived, the connections of the
+        # cancelled downloads should be closed rather than left open
+        bench.fixture.wait_for_idle(5)
+        idle = sum([len(connections) for connections in
+            bench.pc._connection_pool.idle.values()])
+        return {
+            'primary_requests': len(bench.fixture.get_requests(
+                'packages0.test')),
+            'mirror_requests': len(bench.fixture.get_requests(
+                'mirror0.test')),
+            'leaked_connections': bench.fixture.get_open_connections() - idle
+        }
+
+    def check(self, bench, results):
+        return {
+            'every package installed': not [result for result in results if
+                len(result['install_seconds']) != len(self.names)],
+            'no install waits for the slow host': not [result for result in
+                results if max(result['install_seconds']) >= 1],
+            'later downloads start with the faster mirror': not [result for
+                result in results if result['primary_requests'] >=
+                len(self.names)],
+            'installed versions match': not [name for name in self.names if
+                bench.get_installed_version(name) !=
+                bench.fixture.get_version(name)],
+            'cancelled downloads closed their connections': all_equal(
+                results, 'leaked_connections', 0)
+        }
+
+
+class ResumedDownloads(Scenario):
+    name = 'resumed_downloads'
+    description = 'Install 8 packages from a host that drops the ' + \
+        'connection after 2000 bytes of each package file'
+    fixture = {'files_per_package': 20, 'file_size': 4096, 'sha256': True,
+        'host_options': {'packages0.test': {'drop_after': 2000}}}
+
+    def prepare(self, bench):
+        self.names = bench.fixture.get_package_names()[0:8]
+        self.packages = bench.manager().list_available_packages()
+        self.package_bytes = sum([len(bench.fixture.get_zip(name,
+            bench.fixture.get_version(name))) for name in self.names])
+
+    def reset(self, bench):
+        bench.remove_packages()
+
+    def run(self, bench):
+        manager = bench.manager()
+        installed = [name for name in self.names if
+            manager.install_package(name, packages=self.packages)]
+        return {'installed': len(installed),
+            'package_bytes': self.package_bytes}
+
+    def check(self, bench, results):
+        count = len(self.names)
+        return {
+            'every package installed': all_equal(results, 'installed',
+                count),
+            'every download was interrupted': not [result for result in
+                results if result['counters'].get('dropped') != count],
+            'each download resumed with one range request': all_equal(
+                results, 'statuses', {'200': count, '206': count}),
+            'no bytes downloaded twice': not [result for result in results if
+                result['bytes'] != result['package_bytes']]
+        }
+
+
+class CompressedJson(Scenario):
+    name = 'compressed_json'
+    description = 'Refresh the list of packages from a server that ' + \
+        'gzips JSON, counting the bytes on the wire and once decoded'
+    fixture = {'embedded_repositories': 50}
+
+    def run(self, bench):
+        packages = bench.manager().list_available_packages()
+        stats = bench.pc._transfer_stats
+        return {'packages': len(packages), 'wire_bytes': stats.wire,
+            'decoded_bytes': stats.decoded,
+            'gzip_responses': len([request for request in
+                bench.fixture.get_requests() if
+                request['encoding'] == 'gzip'])}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'every response compressed': not [result for result in results
+                if result['gzip_responses'] != result['requests']],
+            'wire bytes counted as sent': not [result for result in results
+                if result['wire_bytes'] != result['bytes']],
+            'under a fifth of the decoded size sent': not [result for result
+                in results if result['wire_bytes'] * 5 >
+                result['decoded_bytes']]
+        }
+
+
+class UncompressedJson(CompressedJson):
+    name = 'uncompressed_json'
+    description = 'The same as compressed_json with a server that ' + \
+        'doesn\'t compress, for comparison'
+    fixture = {'embedded_repositories': 50, 'gzip': False}
+
+    def check(self, bench, results):
+        return {
+            'every package listed': all_equal(results, 'packages',
+                get_package_count(bench)),
+            'wire bytes counted as sent': not [result for result in results
+                if result['wire_bytes'] != result['bytes']],
+            'decoded size matches': not [result for result in results if
+                result['wire_bytes'] != result['decoded_bytes']]
+        }
+
+
+scenarios = [ListRepositories(), ListAvailablePackages(), MakePackageList(),
+    InstallPackage(), AutomaticUpgrader(), RepositoryScheduler(),
+    CacheRevalidation(), ConnectionReuse(), RateLimitRetryAfter(),
+    RateLimitPacing(), RateLimitFailFast(), CoalescedRefresh(),
+    CoalescedRefreshUncached(), DeltaSync(), DeltaSyncWithoutEtags(),
+    HedgedDownloads(), ResumedDownloads(), CompressedJson(),
+    UncompressedJson()]
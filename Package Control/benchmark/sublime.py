@@ -0,0 +1,138 @@
+# A stand-in for the sublime module so that Package Control can be loaded
+# and benchmarked outside of Sublime Text. Only the functions Package
+# Control calls are provided.
+import os
+import sys
+import re
+import json
+import threading
+import tempfile
+
+# The folder holding Packages/, Installed Packages/ and the other folders
+# Sublime Text would normally provide. The runner sets this before loading
+# Package Control.
+data_path = os.environ.get('PACKAGE_CONTROL_BENCHMARK_DATA') or \
+    tempfile.mkdtemp(prefix='pc-benchmark-')
+
+# Default settings files are read from the Package Control folder
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Callbacks passed to set_timeout() are dropped while this is False, which
+# keeps the startup work queued when the module is loaded from running
+timeouts_enabled = True
+
+# Every message passed to error_message(), so scenarios can check for them
+errors = []
+
+_settings = {}
+_settings_lock = threading.Lock()
+
+
+class Settings():
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def erase(self, name):
+        if name in self.values:
+            del self.values[name]
+
+    def has(self, name):
+        return name in self.values
+
+
+def load_default_settings(name):
+    path = os.path.join(package_path, name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        content = f.read()
+    # Settings files allow comments on their own lines
+    content = re.sub('(?m)^\s*//.*$', '', content)
+    return json.loads(content)
+
+
+def load_settings(name):
+    _settings_lock.acquire()
+    try:
+        if name not in _settings:
+            _settings[name] = Settings(load_default_settings(name))
+        return _settings[name]
+    finally:
+        _settings_lock.release()
+
+
+def save_settings(name):
+    pass
+
+
+def reset_settings():
+    _settings_lock.acquire()
+    try:
+        _settings.clear()
+    finally:
+        _settings_lock.release()
+
+
+def set_timeout(callback, delay):
+    if not timeouts_enabled:
+        return
+    timer = threading.Timer(delay / 1000.0, callback)
+    timer.daemon = True
+    timer.start()
+
+
+def platform():
+    if sys.platform == 'darwin':
+        return 'osx'
+    if sys.platform == 'win32':
+        return 'windows'
+    return 'linux'
+
+
+def arch():
+    if sys.maxsize > 2 ** 32:
+        return 'x64'
+    return 'x32'
+
+
+def version():
+    return '2221'
+
+
+def packages_path():
+    return os.path.join(data_path, 'Packages')
+
+
+def installed_packages_path():
+    return os.path.join(data_path, 'Installed Packages')
+
+
+def error_message(message):
+    errors.append(message)
+    print >> sys.stderr, 'error_message: %s' % message
+
+
+def message_dialog(message):
+    print message
+
+
+def ok_cancel_dialog(message, ok_title=''):
+    return True
+
+
+def status_message(message):
+    pass
+
+
+def active_window():
+    return None
+
+
+def windows():
+    return []
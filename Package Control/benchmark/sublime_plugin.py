@@ -0,0 +1,20 @@
+# A stand-in for the sublime_plugin module, providing the base classes that
+# Package Control subclasses
+
+
+class ApplicationCommand():
+    pass
+
+
+class WindowCommand():
+    def __init__(self, window=None):
+        self.window = window
+
+
+class TextCommand():
+    def __init__(self, view=None):
+        self.view = view
+
+
+class EventListener():
+    pass